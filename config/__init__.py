@@ -1,4 +1,5 @@
 import os
+from types import MappingProxyType
 
 from dotenv import load_dotenv
 
@@ -6,9 +7,12 @@ load_dotenv()
 
 from . import base, dev, production
 
-SETTINGS = base.SETTINGS
+_settings = dict(base.SETTINGS)
 
 if os.getenv('DEBUG'):
-    SETTINGS.update(dev.SETTINGS)
+    _settings.update(dev.SETTINGS)
 else:
-    SETTINGS.update(production.SETTINGS)
+    _settings.update(production.SETTINGS)
+
+# settings are resolved once at import and exposed read-only
+SETTINGS = MappingProxyType(_settings)
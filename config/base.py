@@ -12,11 +12,19 @@ SETTINGS = {
     # app
     'DATASET_STATE_DIR': os.getenv('DATASET_STATE_DIR'),
     "AFRICA_SHP_PATH": os.getenv('AFRICA_SHP_PATH'),
-    "REQUESTS_TIMEOUT": os.getenv('AFRICA_SHP_PATH', 300),
+    "REQUESTS_TIMEOUT": int(os.getenv('REQUESTS_TIMEOUT', 300)),
+    # engine used to convert grib files to netcdf, either cfgrib or cdo
+    "GRIB_TO_NETCDF_ENGINE": os.getenv('GRIB_TO_NETCDF_ENGINE', "cfgrib"),
+    # compression for COG outputs e.g DEFLATE or ZSTD, if supported by the GSKY GDAL build
+    "COG_COMPRESS": os.getenv('COG_COMPRESS', "DEFLATE"),
+    # directory for large intermediate files e.g a tmpfs like /dev/shm. Defaults to the system temp dir
+    "INGEST_TMPDIR": os.getenv('INGEST_TMPDIR'),
 
     # GSKY Settings
     'GSKY_INGEST_LAYER_WEBHOOK_URL': os.getenv('GSKY_INGEST_LAYER_WEBHOOK_URL'),
     'GSKY_WEBHOOK_SECRET': os.getenv('GSKY_WEBHOOK_SECRET'),
+    # number of ingest webhook calls in flight at once
+    'GSKY_INGEST_WORKERS': int(os.getenv('GSKY_INGEST_WORKERS', 8)),
 
     # Dust Forecast
     'DUST_AEMET_USERNAME': os.getenv('DUST_AEMET_USERNAME'),
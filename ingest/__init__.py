@@ -1,22 +1,39 @@
-import codecs
-import hashlib
+import functools
 import hmac
 import logging
 import subprocess
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
 import fiona
-import requests
 from shapely.geometry import shape
 
 from config import SETTINGS
 from ingest.errors import ParameterMissing
 from ingest.raster_vector import VectorDbManager
-from ingest.utils import read_state, update_state, delete_past_data_files, convert_data, generate_contour_geojson, \
-    create_contour_data
+from ingest.utils import read_state, update_state, delete_past_data_files, convert_data, create_contour_data, \
+    http_session, REQUESTS_TIMEOUT, open_grib_dataset
 
 GSKY_INGEST_LAYER_WEBHOOK_URL = SETTINGS.get("GSKY_INGEST_LAYER_WEBHOOK_URL")
 GSKY_WEBHOOK_SECRET = SETTINGS.get("GSKY_WEBHOOK_SECRET")
+# HMAC key, encoded once
+GSKY_WEBHOOK_SECRET_KEY = GSKY_WEBHOOK_SECRET.encode() if GSKY_WEBHOOK_SECRET else None
+GRIB_TO_NETCDF_ENGINE = SETTINGS.get("GRIB_TO_NETCDF_ENGINE")
+
+# GSKY ingest arguments shared by all datasets, one tif per timestamp
+INGEST_DATATYPE_ARG = "-t tif"
+INGEST_RULESET_ARGS = "-x -conf /rulesets/namespace_yyy-mm-ddTH.tif.json"
+
+# background pool for ingest webhook calls, shared by all datasets
+INGEST_COMMAND_EXECUTOR = ThreadPoolExecutor(max_workers=SETTINGS.get("GSKY_INGEST_WORKERS"),
+                                             thread_name_prefix="ingest_command")
+
+
+@functools.lru_cache(maxsize=1)
+def load_africa_geom(shp_path):
+    # read shapefile once per process and convert first feature to shapely shape
+    with fiona.open(shp_path) as shp:
+        return shape(next(iter(shp))['geometry'])
 
 
 class DataIngest(object):
@@ -31,6 +48,7 @@ class DataIngest(object):
         self.output_dir = output_dir
         self.africa_shp_path = SETTINGS.get("AFRICA_SHP_PATH")
         self.cleanup_data = cleanup_old_data
+        self.pending_ingest_commands = []
 
     def run(self, **kwargs):
         raise NotImplementedError
@@ -47,10 +65,7 @@ class DataIngest(object):
         update_state(self.dataset_id, state)
 
     def clip_to_africa(self, ds):
-        # read shapefile
-        shp = fiona.open(self.africa_shp_path)
-        # convert first feature to shapely shape
-        geom = shape(shp[0]['geometry'])
+        geom = load_africa_geom(self.africa_shp_path)
 
         ds = ds.rio.clip([geom], 'epsg:4326', drop=True)
 
@@ -73,7 +88,8 @@ class DataIngest(object):
     @staticmethod
     def grib_to_netcdf(input_file, output_file):
         """
-        Converts a GRIB file to netCDF format using CDO.
+        Converts a GRIB file to netCDF format, in-process using cfgrib or with CDO
+        when GRIB_TO_NETCDF_ENGINE is set to "cdo".
 
         Args:
             input_file (str): Path to the input GRIB file.
@@ -82,32 +98,68 @@ class DataIngest(object):
         Returns:
             output_file (str): Path to the output netCDF file.
         """
-        # Construct the CDO command to convert the file
-        command = f"cdo -f nc copy {input_file} {output_file}"
+        if GRIB_TO_NETCDF_ENGINE == "cdo":
+            # Construct the CDO command to convert the file
+            command = ["cdo", "-f", "nc", "copy", input_file, output_file]
 
-        # Execute the command using subprocess
-        subprocess.run(command, shell=True, check=True)
+            # Execute the command directly, without an intermediate shell
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+            return output_file
+
+        ds = open_grib_dataset(input_file)
+        try:
+            encoding = {var: {"zlib": True, "complevel": 1} for var in ds.data_vars}
+            ds.to_netcdf(output_file, engine="netcdf4", encoding=encoding)
+        finally:
+            ds.close()
 
         return output_file
 
     @staticmethod
     def send_ingest_command(payload):
         if GSKY_INGEST_LAYER_WEBHOOK_URL and GSKY_WEBHOOK_SECRET:
-            request = requests.Request(method="POST", url=f"{GSKY_INGEST_LAYER_WEBHOOK_URL}", data=payload, headers={})
-            prepped = request.prepare()
-            # generate signature for auth
-            signature = hmac.new(codecs.encode(GSKY_WEBHOOK_SECRET), codecs.encode(prepped.body),
-                                 digestmod=hashlib.sha256)
-            prepped.headers['X-Gsky-Signature'] = signature.hexdigest()
-
-            with requests.Session() as session:
-                response = session.send(prepped)
-                logging.info(f"[INGEST]: Ingest command sent successfully for namespace {payload.get('namespace')}")
-                logging.info(response.text)
+            # encode form body once, the signature is computed over these exact bytes
+            body = urlencode(payload).encode()
+            # generate signature for auth. Passing the digest by name uses the OpenSSL
+            # HMAC implementation directly, which is hardware accelerated where available
+            signature = hmac.new(GSKY_WEBHOOK_SECRET_KEY, body, digestmod="sha256")
+            headers = {
+                "X-Gsky-Signature": signature.hexdigest(),
+                "Content-Type": "application/x-www-form-urlencoded"
+            }
+
+            # reuse pooled connection to the webhook
+            response = http_session.post(GSKY_INGEST_LAYER_WEBHOOK_URL, data=body, headers=headers,
+                                         timeout=REQUESTS_TIMEOUT)
+            logging.info(f"[INGEST]: Ingest command sent successfully for namespace {payload.get('namespace')}")
+            logging.info(response.text)
             return True
 
         return False
 
+    @staticmethod
+    def get_ingest_payload(namespace, data_dir):
+        return {
+            "namespace": f"-n {namespace}",
+            "path": f"-p {data_dir}",
+            "datatype": INGEST_DATATYPE_ARG,
+            "args": INGEST_RULESET_ARGS
+        }
+
+    def dispatch_ingest_command(self, payload):
+        """Send ingest command in the background, so processing continues while the request is in flight.
+        Call wait_for_ingest_commands before updating state to make sure all commands were sent."""
+        future = INGEST_COMMAND_EXECUTOR.submit(self.send_ingest_command, payload)
+        self.pending_ingest_commands.append(future)
+        return future
+
+    def wait_for_ingest_commands(self):
+        pending, self.pending_ingest_commands = self.pending_ingest_commands, []
+        # re-raise any error from sending the commands
+        for future in pending:
+            future.result()
+
     def cleanup_old_data(self, latest_date_str, data_dir):
         if self.cleanup_data:
             logging.info(f"[DATASET CLEANUP]: Cleaning up old {self.dataset_id} files for date: {latest_date_str}")
@@ -116,21 +168,21 @@ class DataIngest(object):
     @staticmethod
     def create_contour_data(raster_file_path, conn_params, date_str, table_name, attr_name, interval,
                             latest_date_str=None):
-        with tempfile.TemporaryDirectory() as temp_dir:
-            geojson_file = create_contour_data(raster_file_path,
-                                               attr_name=attr_name,
-                                               interval=interval,
-                                               out_dir=temp_dir)
-            data_columns = [attr_name]
-
-            db = VectorDbManager(
-                conn_params=conn_params,
-                schema_name="pgadapter",
-                table_name=table_name,
-                geom_type="LineString",
-                data_columns=data_columns,
-                srid=4326
-            )
-
-            # insert data
-            db.insert_update_data(date_str, geojson_file, latest_date_str=latest_date_str)
+        # contours are generated in memory and loaded straight from the layer
+        contour_ds = create_contour_data(raster_file_path, attr_name=attr_name, interval=interval)
+        data_columns = [attr_name]
+
+        db = VectorDbManager(
+            conn_params=conn_params,
+            schema_name="pgadapter",
+            table_name=table_name,
+            geom_type="LineString",
+            data_columns=data_columns,
+            srid=4326
+        )
+
+        # insert data
+        try:
+            db.insert_update_layer(date_str, contour_ds.GetLayer(0), latest_date_str=latest_date_str)
+        finally:
+            db.close()
@@ -1,13 +1,15 @@
 import datetime
+import functools
 import logging
 import os
 import tempfile
 from pathlib import Path
 
 from ingest import DataIngest
+from ingest.utils import COG_CREATION_OPTIONS, run_concurrently, format_time_values
 import cdsapi
 import xarray as xr
-import pandas as pd
+from requests.adapters import HTTPAdapter
 
 CONFIG = {
     "params": [
@@ -22,6 +24,19 @@ CONFIG = {
 }
 
 
+def cds_error_callback(*args):
+    if args[0].startswith("Reason"):
+        logging.warning(f"[CAMS_FORECAST]: CDS API message: {args[1]}")
+
+
+@functools.lru_cache(maxsize=None)
+def get_cds_client(url, api_key):
+    # one client per api url and key, so its session and pooled connections are reused across runs
+    client = cdsapi.Client(url=url, key=api_key, quiet=True, error_callback=cds_error_callback)
+    client.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=20))
+    return client
+
+
 class CamsForecast(DataIngest):
     def __init__(self, dataset_id, output_dir, api_key, cleanup_old_data=True):
         super().__init__(dataset_id=dataset_id, output_dir=output_dir, cleanup_old_data=cleanup_old_data)
@@ -29,12 +44,7 @@ class CamsForecast(DataIngest):
         self.lead_times = CONFIG.get("lead_times")
 
         self.cams_url = "https://ads.atmosphere.copernicus.eu/api/v2"
-        self.client = cdsapi.Client(url=self.cams_url, key=api_key, quiet=True, error_callback=self.error_callback)
-
-    @staticmethod
-    def error_callback(*args):
-        if args[0].startswith("Reason"):
-            logging.warning(f"[CAMS_FORECAST]: CDS API message: {args[1]}")
+        self.client = get_cds_client(self.cams_url, api_key)
 
     def run(self, **kwargs):
         logging.info("[CAMS_FORECAST]: Trying...")
@@ -83,41 +93,46 @@ class CamsForecast(DataIngest):
             data_dir = f"{self.output_dir}/{namespace}"
 
             if data_var in ds.variables:
-                for t_index, dt in enumerate(ds.time.values):
-                    data_datetime = pd.to_datetime(str(dt))
-                    date_str = data_datetime.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-                    # output filename
-                    param_t_filename = f"{data_dir}/{namespace}_{date_str}.tif"
+                # create output directory if it does not exist
+                Path(data_dir).absolute().mkdir(parents=True, exist_ok=True)
 
-                    # create output directory if it does not exist
-                    Path(param_t_filename).parent.absolute().mkdir(parents=True, exist_ok=True)
+                # read variable once, so that the writer threads do not contend on the source file
+                var_data_array = ds[data_var].load()
 
-                    data_array = ds[data_var].isel(time=t_index)
-                    # data_array.attrs['_FillValue'] = -9999.0
-                    # data_array = data_array.rio.write_nodata(-9999, encoded=True)
-                    units = data_array.attrs.get('units')
-                    if units and isinstance(units, tuple):
-                        data_array.attrs['units'] = units[0]
-
-                    logging.info(f"[CAMS_FORECAST]: Saving {namespace} data for date: {date_str}")
-                    data_array.rio.to_raster(param_t_filename, driver="COG", compress="DEFLATE")
+                # write time slices concurrently
+                date_strs = format_time_values(ds.time.values)
+                run_concurrently(self.save_time_slice,
+                                 [(var_data_array, t_index, date_str, namespace, data_dir)
+                                  for t_index, date_str in enumerate(date_strs)])
 
             # cleanup old forecasts before ingestion
             self.cleanup_old_data(next_date.isoformat(), data_dir)
 
-            ingest_payload = {
-                "namespace": f"-n {namespace}",
-                "path": f"-p {data_dir}",
-                "datatype": "-t tif",
-                "args": "-x -conf /rulesets/namespace_yyy-mm-ddTH.tif.json"
-            }
+            ingest_payload = self.get_ingest_payload(namespace, data_dir)
 
             logging.info(
                 f"[CAMS_FORECAST]: Sending ingest command for {namespace} and starting date: {next_date.isoformat()}")
-            self.send_ingest_command(ingest_payload)
+            self.dispatch_ingest_command(ingest_payload)
 
         # cleanup
         os.remove(data_download_file)
 
+        self.wait_for_ingest_commands()
+
         # update state
         self.update_state({"last_update": next_date.isoformat()})
+
+    @staticmethod
+    def save_time_slice(var_data_array, t_index, date_str, namespace, data_dir):
+        # output filename
+        param_t_filename = f"{data_dir}/{namespace}_{date_str}.tif"
+
+        data_array = var_data_array.isel(time=t_index)
+        # data_array.attrs['_FillValue'] = -9999.0
+        # data_array = data_array.rio.write_nodata(-9999, encoded=True)
+        units = data_array.attrs.get('units')
+        if units and isinstance(units, tuple):
+            data_array.attrs['units'] = units[0]
+
+        logging.info(f"[CAMS_FORECAST]: Saving {namespace} data for date: {date_str}")
+        data_array.rio.to_raster(param_t_filename, **COG_CREATION_OPTIONS)
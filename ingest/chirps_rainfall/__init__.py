@@ -3,16 +3,21 @@ import logging
 import os
 import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
+import dask
+import numpy as np
+import rasterio
+import rasterio.shutil
 import requests
 import rioxarray as rxr
 import xarray as xr
 
 from ingest import DataIngest
 from ingest.dateutils import get_next_month_date, get_next_pentad
-from ingest.utils import download_file_temp
+from ingest.utils import http_session, REQUESTS_TIMEOUT, is_non_empty_file, COG_CREATION_OPTIONS, get_temp_dir
 
 CONFIG = {
     "periods": {
@@ -37,6 +42,15 @@ CONFIG = {
     }
 }
 
+# number of parallel downloads when fetching climatology files
+CLIMATOLOGY_DOWNLOAD_WORKERS = 8
+
+# dask chunks used when combining climatology files
+CLIMATOLOGY_CHUNKS = {"x": 2048, "y": 2048}
+
+# tile size used when computing anomalies window by window
+ANOMALY_BLOCK_SIZE = 512
+
 
 class ChirpsRainfall(DataIngest):
     def __init__(self, dataset_id, output_dir, cleanup_old_data=False):
@@ -91,18 +105,6 @@ class ChirpsRainfall(DataIngest):
 
                 nodata_value = -9999
 
-                data_array_current = rxr.open_rasterio(current_data_file)
-                data_array_current = data_array_current.rio.write_nodata(nodata_value, encoded=True)
-
-                data_array_normal = rxr.open_rasterio(normal_file)
-                data_array_normal = data_array_normal.rio.write_nodata(nodata_value, encoded=True)
-
-                mask_da1 = data_array_current != nodata_value
-                mask_da2 = data_array_normal != nodata_value
-
-                # calculate anomaly
-                data_array_anomaly = xr.where(mask_da1 & mask_da2, data_array_current - data_array_normal, nodata_value)
-
                 date_str = next_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
                 namespace = f"monthly_chirps_rainfall_anomaly"
 
@@ -111,20 +113,14 @@ class ChirpsRainfall(DataIngest):
 
                 Path(out_file).parent.absolute().mkdir(parents=True, exist_ok=True)
 
-                data_array_anomaly = data_array_anomaly.rio.write_nodata(-9999, encoded=True)
-                data_array_anomaly.rio.write_crs("epsg:4326", inplace=True)
-                data_array_anomaly.rio.to_raster(out_file, driver="COG", compress="DEFLATE")
+                # calculate anomaly
+                self.write_anomaly(current_data_file, normal_file, out_file, nodata_value)
 
-                ingest_payload = {
-                    "namespace": f"-n {namespace}",
-                    "path": f"-p {data_dir}",
-                    "datatype": "-t tif",
-                    "args": "-x -conf /rulesets/namespace_yyy-mm-ddTH.tif.json"
-                }
+                ingest_payload = self.get_ingest_payload(namespace, data_dir)
 
                 logging.info(
                     f"[CHIRPS_RAINFALL]: Sending ingest command for period: monthly  param: {namespace} and date: {date_str}")
-                self.send_ingest_command(ingest_payload)
+                self.dispatch_ingest_command(ingest_payload)
         except requests.exceptions.HTTPError as e:
             # file not found
             if e.response.status_code == 404:
@@ -133,6 +129,9 @@ class ChirpsRainfall(DataIngest):
                 return
             else:
                 raise e
+        # make sure all ingest commands were sent before updating state
+        self.wait_for_ingest_commands()
+
         # update state
         self.update_state({"monthly": next_date.isoformat()})
 
@@ -179,18 +178,6 @@ class ChirpsRainfall(DataIngest):
 
                 nodata_value = -9999
 
-                data_array_current = rxr.open_rasterio(current_data_file)
-                data_array_current = data_array_current.rio.write_nodata(nodata_value, encoded=True)
-
-                data_array_normal = rxr.open_rasterio(normal_file)
-                data_array_normal = data_array_normal.rio.write_nodata(nodata_value, encoded=True)
-
-                mask_da1 = data_array_current != nodata_value
-                mask_da2 = data_array_normal != nodata_value
-
-                # calculate anomaly
-                data_array_anomaly = xr.where(mask_da1 & mask_da2, data_array_current - data_array_normal, nodata_value)
-
                 date_str = next_pentad_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
                 namespace = f"pentadal_chirps_rainfall_anomaly"
 
@@ -199,20 +186,14 @@ class ChirpsRainfall(DataIngest):
 
                 Path(out_file).parent.absolute().mkdir(parents=True, exist_ok=True)
 
-                data_array_anomaly = data_array_anomaly.rio.write_nodata(-9999, encoded=True)
-                data_array_anomaly.rio.write_crs("epsg:4326", inplace=True)
-                data_array_anomaly.rio.to_raster(out_file, driver="COG", compress="DEFLATE")
+                # calculate anomaly
+                self.write_anomaly(current_data_file, normal_file, out_file, nodata_value)
 
-                ingest_payload = {
-                    "namespace": f"-n {namespace}",
-                    "path": f"-p {data_dir}",
-                    "datatype": "-t tif",
-                    "args": "-x -conf /rulesets/namespace_yyy-mm-ddTH.tif.json"
-                }
+                ingest_payload = self.get_ingest_payload(namespace, data_dir)
 
                 logging.info(
                     f"[CHIRPS_RAINFALL]: Sending ingest command for period: pentadal  param: {namespace} and date: {date_str}")
-                self.send_ingest_command(ingest_payload)
+                self.dispatch_ingest_command(ingest_payload)
         except requests.exceptions.HTTPError as e:
             # file not found
             if e.response.status_code == 404:
@@ -221,11 +202,24 @@ class ChirpsRainfall(DataIngest):
                 return
             else:
                 raise e
+        # make sure all ingest commands were sent before updating state
+        self.wait_for_ingest_commands()
+
         # update state
         self.update_state({"pentadal": next_pentad_date.isoformat()})
 
     # get climatological mean for a given month and period [start_year, end_year]
     def get_month_normal(self, month, climatology_period, file_template):
+        start_year, end_year = climatology_period
+
+        monthly_normals_dir = f"{self.output_dir}/normals_{start_year}_{end_year}/monthly"
+        normal_file_out = os.path.join(monthly_normals_dir,
+                                       f"chirps_monthly_normal_{month}_{start_year}_{end_year}.tif")
+
+        # the file name is unique for the month and climatology period, reuse it if already computed
+        if is_non_empty_file(normal_file_out):
+            return normal_file_out
+
         state = self.get_state() or {}
         monthly_normals = state.get("monthly_normals", {})
         normal = monthly_normals.get(month)
@@ -233,40 +227,40 @@ class ChirpsRainfall(DataIngest):
         if normal and os.path.exists(normal):
             return normal
 
-        start_year, end_year = climatology_period
-
         logging.info(f"[CHIRPS_RAINFALL]: Getting Monthly normals for month :{month}")
-        with tempfile.TemporaryDirectory() as temp_dir:
+        with tempfile.TemporaryDirectory(dir=get_temp_dir()) as temp_dir:
+            urls = []
             for year in range(start_year, end_year + 1):
                 file_path = file_template. \
                     replace("{YYYY}", f"{year}"). \
                     replace("{MM}", month)
-                url = f"{self.base_data_url}{file_path}"
+                urls.append(f"{self.base_data_url}{file_path}")
 
-                file_name = os.path.basename(url)[:-3]
-                out_file = os.path.join(temp_dir, file_name)
-                logging.info(f"[CHIRPS_RAINFALL]: Downloading data for year: {year} and month : {month}")
-                self.download_chirps_tif(url, out_file)
+            logging.info(f"[CHIRPS_RAINFALL]: Downloading data for years: {start_year} - {end_year} and month : {month}")
+            self.download_chirps_tifs(urls, temp_dir)
 
             file_pattern = f"{temp_dir}/*tif"
             logging.info(f"[CHIRPS_RAINFALL]: Combining monthly data for years: {start_year}, {end_year}")
-            ds = xr.open_mfdataset(file_pattern, combine='nested', concat_dim='band', engine="rasterio")
+            # open files concurrently and compute mean as a chunked reduction across all cores
+            with dask.config.set(scheduler="threads", num_workers=os.cpu_count()):
+                ds = xr.open_mfdataset(file_pattern, combine='nested', concat_dim='band', engine="rasterio",
+                                       chunks=CLIMATOLOGY_CHUNKS, parallel=True)
+
+                # write crs
+                ds.rio.write_crs("epsg:4326", inplace=True)
 
-            # write crs
-            ds.rio.write_crs("epsg:4326", inplace=True)
-            mean_ds = ds.mean(dim='band')
+                mean_ds = ds.mean(dim='band').compute()
 
-            monthly_normals_dir = f"{self.output_dir}/normals_{start_year}_{end_year}/monthly"
-            normal_file_out = os.path.join(monthly_normals_dir,
-                                           f"chirps_monthly_normal_{month}_{start_year}_{end_year}.tif")
             Path(normal_file_out).parent.absolute().mkdir(parents=True, exist_ok=True)
 
             data_array = mean_ds["band_data"]
             data_array.rio.write_crs("epsg:4326", inplace=True)
             data_array = data_array.rio.write_nodata(-9999, encoded=True)
 
-            # save mean file
-            data_array.rio.to_raster(normal_file_out, driver="COG", compress="DEFLATE")
+            # save mean file, renaming once complete so that a partial write is never reused
+            normal_file_tmp = f"{normal_file_out}.tmp"
+            data_array.rio.to_raster(normal_file_tmp, **COG_CREATION_OPTIONS)
+            os.replace(normal_file_tmp, normal_file_out)
 
             # update state
             monthly_normals.update({month: normal_file_out})
@@ -276,6 +270,16 @@ class ChirpsRainfall(DataIngest):
 
     # get climatological mean for a given month and pentad [start_year, end_year]
     def get_pentad_normal(self, month, pentad_num, climatology_period, file_template):
+        start_year, end_year = climatology_period
+
+        pentadsl_normals_dir = f"{self.output_dir}/normals_{start_year}_{end_year}/pentadal"
+        normal_file_out = os.path.join(pentadsl_normals_dir,
+                                       f"chirps_pentadal_normal_{month}_{pentad_num}_{start_year}_{end_year}.tif")
+
+        # the file name is unique for the pentad and climatology period, reuse it if already computed
+        if is_non_empty_file(normal_file_out):
+            return normal_file_out
+
         state = self.get_state() or {}
         pentad_normals = state.get("pentad_normals", {})
         month_pentad = f"{month}_{pentad_num}"
@@ -285,43 +289,43 @@ class ChirpsRainfall(DataIngest):
         if normal and os.path.exists(normal):
             return normal
 
-        start_year, end_year = climatology_period
-
         logging.info(f"[CHIRPS_RAINFALL]: Getting Pentad normals for month: {month} and pentad: {pentad_num}")
-        with tempfile.TemporaryDirectory() as temp_dir:
+        with tempfile.TemporaryDirectory(dir=get_temp_dir()) as temp_dir:
+            urls = []
             for year in range(start_year, end_year + 1):
                 file_path = file_template. \
                     replace("{YYYY}", f"{year}"). \
                     replace("{MM}", month). \
                     replace("{P}", f"{pentad_num}")
+                urls.append(f"{self.base_data_url}{file_path}")
 
-                url = f"{self.base_data_url}{file_path}"
-
-                file_name = os.path.basename(url)[:-3]
-                out_file = os.path.join(temp_dir, file_name)
-                logging.info(
-                    f"[CHIRPS_RAINFALL]: Downloading pentad data for year: {year}, month: {month} and pentad: {pentad_num}")
-                self.download_chirps_tif(url, out_file)
+            logging.info(
+                f"[CHIRPS_RAINFALL]: Downloading pentad data for years: {start_year} - {end_year}, month: {month} "
+                f"and pentad: {pentad_num}")
+            self.download_chirps_tifs(urls, temp_dir)
 
             file_pattern = f"{temp_dir}/*tif"
             logging.info(f"[CHIRPS_RAINFALL]: Combining monthly pentad data for years: {start_year}, {end_year}")
-            ds = xr.open_mfdataset(file_pattern, combine='nested', concat_dim='band', engine="rasterio")
+            # open files concurrently and compute mean as a chunked reduction across all cores
+            with dask.config.set(scheduler="threads", num_workers=os.cpu_count()):
+                ds = xr.open_mfdataset(file_pattern, combine='nested', concat_dim='band', engine="rasterio",
+                                       chunks=CLIMATOLOGY_CHUNKS, parallel=True)
+
+                # write crs
+                ds.rio.write_crs("epsg:4326", inplace=True)
 
-            # write crs
-            ds.rio.write_crs("epsg:4326", inplace=True)
-            mean_ds = ds.mean(dim='band')
+                mean_ds = ds.mean(dim='band').compute()
 
-            pentadsl_normals_dir = f"{self.output_dir}/normals_{start_year}_{end_year}/pentadal"
-            normal_file_out = os.path.join(pentadsl_normals_dir,
-                                           f"chirps_pentadal_normal_{month}_{pentad_num}_{start_year}_{end_year}.tif")
             Path(normal_file_out).parent.absolute().mkdir(parents=True, exist_ok=True)
 
             data_array = mean_ds["band_data"]
             data_array.rio.write_crs("epsg:4326", inplace=True)
             data_array = data_array.rio.write_nodata(-9999, encoded=True)
 
-            # save mean file
-            data_array.rio.to_raster(normal_file_out, driver="COG", compress="DEFLATE")
+            # save mean file, renaming once complete so that a partial write is never reused
+            normal_file_tmp = f"{normal_file_out}.tmp"
+            data_array.rio.to_raster(normal_file_tmp, **COG_CREATION_OPTIONS)
+            os.replace(normal_file_tmp, normal_file_out)
 
             # update state
             pentad_normals.update({month_pentad: normal_file_out})
@@ -329,16 +333,57 @@ class ChirpsRainfall(DataIngest):
 
             return pentad_normals.get(month_pentad)
 
+    @staticmethod
+    def write_anomaly(current_file, normal_file, out_file, nodata_value):
+        with rasterio.open(current_file) as src_current, rasterio.open(normal_file) as src_normal:
+            # the windows of the current file are read from the normal, both must be on the same grid
+            if src_current.shape != src_normal.shape or not src_current.transform.almost_equals(src_normal.transform):
+                raise ValueError(f"Normal {normal_file} grid {src_normal.shape} {src_normal.transform} does not match "
+                                 f"{current_file} grid {src_current.shape} {src_current.transform}")
+
+            profile = src_current.profile
+            profile.update(driver="GTiff", dtype="float32", count=1, nodata=nodata_value, crs="EPSG:4326",
+                           tiled=True, blockxsize=ANOMALY_BLOCK_SIZE, blockysize=ANOMALY_BLOCK_SIZE)
+
+            # the COG driver can only create by copy, so compute tile by tile into a tiled GTiff first
+            with tempfile.NamedTemporaryFile(suffix=".tif", dir=get_temp_dir()) as tmp_file:
+                with rasterio.open(tmp_file.name, "w", **profile) as dst:
+                    for _, window in dst.block_windows(1):
+                        current = src_current.read(1, window=window)
+                        normal = src_normal.read(1, window=window)
+
+                        # subtract in a single pass, leaving nodata wherever either input has no data
+                        anomaly = np.full(current.shape, nodata_value, dtype=np.float32)
+                        mask = (current != nodata_value) & (normal != nodata_value)
+                        np.subtract(current, normal, out=anomaly, where=mask)
+
+                        dst.write(anomaly, 1, window=window)
+
+                rasterio.shutil.copy(tmp_file.name, out_file, **COG_CREATION_OPTIONS)
+
+        return out_file
+
     @staticmethod
     def download_chirps_tif(url, out_file=None):
-        gz_tif_file = download_file_temp(url)
         if not out_file:
-            out_file = tempfile.NamedTemporaryFile(delete=False, suffix=".tif").name
-        with gzip.open(gz_tif_file, "rb") as gz_file:
-            with open(out_file, "wb") as output_file:
-                shutil.copyfileobj(gz_file, output_file)
+            out_file = tempfile.NamedTemporaryFile(delete=False, suffix=".tif", dir=get_temp_dir()).name
+        # decompress while downloading, without writing the .gz to disk first
+        with http_session.get(url, stream=True, timeout=REQUESTS_TIMEOUT) as r:
+            r.raise_for_status()
+            r.raw.decode_content = False
+            with gzip.GzipFile(fileobj=r.raw) as gz_file:
+                with open(out_file, "wb") as output_file:
+                    shutil.copyfileobj(gz_file, output_file, length=1024 * 1024)
         return out_file
 
+    def download_chirps_tifs(self, urls, out_dir):
+        # download files concurrently, each named after its url without the .gz extension
+        with ThreadPoolExecutor(max_workers=CLIMATOLOGY_DOWNLOAD_WORKERS) as executor:
+            futures = [executor.submit(self.download_chirps_tif, url, os.path.join(out_dir, os.path.basename(url)[:-3]))
+                       for url in urls]
+            # propagate any download error
+            return [future.result() for future in futures]
+
     def download_and_save_file(self, url, period, param, data_date):
         date_str = data_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
         namespace = f"{period}_{param}"
@@ -357,18 +402,13 @@ class ChirpsRainfall(DataIngest):
         data_array_current = data_array_current.rio.write_nodata(-9999, encoded=True)
 
         # save raster file
-        data_array_current.rio.to_raster(out_file, driver="COG", compress="DEFLATE")
+        data_array_current.rio.to_raster(out_file, **COG_CREATION_OPTIONS)
 
-        ingest_payload = {
-            "namespace": f"-n {namespace}",
-            "path": f"-p {data_dir}",
-            "datatype": "-t tif",
-            "args": "-x -conf /rulesets/namespace_yyy-mm-ddTH.tif.json"
-        }
+        ingest_payload = self.get_ingest_payload(namespace, data_dir)
 
         logging.info(
             f"[CHIRPS_RAINFALL]: Sending ingest command for period: {period} param: {namespace} and date: {date_str}")
-        self.send_ingest_command(ingest_payload)
+        self.dispatch_ingest_command(ingest_payload)
 
         # cleanup
         os.remove(tif_file)
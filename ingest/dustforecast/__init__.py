@@ -1,16 +1,14 @@
 import logging
 import os
 from datetime import datetime
+from xml.etree import ElementTree
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
-import requests
 import xarray as xr
-import xmltodict
 
 from ingest import DataIngest, ParameterMissing
-from ingest.utils import download_file_temp
+from ingest.utils import download_file_temp, http_session, run_concurrently, format_time_values, COG_CREATION_OPTIONS
 
 
 class DustForecastIngest(DataIngest):
@@ -53,12 +51,11 @@ class DustForecastIngest(DataIngest):
         url = "https://dust.aemet.es/thredds/catalog/restrictedDataRoot/MULTI-MODEL/latest/catalog.xml"
 
         logging.info(f'[DUST_FORECAST]: Getting  catalog with url: {url}')
-        r = requests.get(url, timeout=self.request_timeout)
+        dataset_name = self.get_catalog_dataset_name(url)
 
-        logging.debug(f'[DUST_FORECAST]: Parsing  catalog')
-        data = xmltodict.parse(r.text)
-
-        dataset_name = data["catalog"]["dataset"]["dataset"]["@name"]
+        if not dataset_name:
+            logging.info(f'[DUST_FORECAST]: No dataset found in remote catalog. Skipping...')
+            return
 
         data_file_date = dataset_name.split("_")[0]
 
@@ -89,26 +86,47 @@ class DustForecastIngest(DataIngest):
                     self.cleanup_old_data(data_file_date, data_dir)
 
                     # Send ingest command
-                    ingest_payload = {
-                        "namespace": f"-n {param}",
-                        "path": f"-p {data_dir}",
-                        "datatype": "-t tif",
-                        "args": "-x -conf /rulesets/namespace_yyy-mm-ddTH.tif.json"
-                    }
+                    ingest_payload = self.get_ingest_payload(param, data_dir)
 
                     logging.info(
                         f"[DUST_FORECAST]: Sending ingest command for param: {param} and date {data_file_date}")
-                    self.send_ingest_command(ingest_payload)
+                    self.dispatch_ingest_command(ingest_payload)
 
+                self.wait_for_ingest_commands()
                 self.update_state({"last_update": data_file_date})
 
+    def get_catalog_dataset_name(self, url):
+        # shared pooled session, the connection is kept alive for the file download from the same host
+        with http_session.get(url, stream=True, timeout=self.request_timeout) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+
+            logging.debug(f'[DUST_FORECAST]: Parsing  catalog')
+            # stream parse the catalog, stopping at the first dataset nested in the top level dataset
+            dataset_depth = 0
+            for event, element in ElementTree.iterparse(r.raw, events=("start", "end")):
+                # ignore the thredds xml namespace
+                if element.tag.rsplit("}", 1)[-1] != "dataset":
+                    continue
+                if event == "start":
+                    dataset_depth += 1
+                    if dataset_depth == 2:
+                        return element.get("name")
+                else:
+                    dataset_depth -= 1
+
+        return None
+
     def process(self, temp_file):
         logging.info(f"[DUST_FORECAST]: Processing data...")
 
-        ds = xr.open_dataset(temp_file)
+        # one dask chunk per time step, so that each slice is only read when written
+        ds = xr.open_dataset(temp_file, chunks={"time": 1})
 
         ds.rio.write_crs("epsg:4326", inplace=True)
 
+        date_strs = format_time_values(ds.time.values)
+
         # ds = self.clip_to_africa(ds)
 
         for var in self.variables:
@@ -117,29 +135,38 @@ class DustForecastIngest(DataIngest):
 
             logging.debug(f"[DUST_FORECAST]: Processing variable: {variable}")
             if variable in ds.variables:
-                for i, t in enumerate(ds.time.values):
-                    logging.debug(f"[DUST_FORECAST]: Processing date: {t}")
-                    data_datetime = pd.to_datetime(str(t))
-                    date_str = data_datetime.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-                    param_t_filename = f"{self.output_dir}/{param}/{param}_{date_str}.tif"
+                data_dir = f"{self.output_dir}/{param}"
+                # output filenames are the prefix followed by the date
+                file_prefix = f"{data_dir}/{param}_"
+
+                # create directory if not exists
+                Path(data_dir).absolute().mkdir(parents=True, exist_ok=True)
 
-                    # create directory if not exists
-                    Path(param_t_filename).parent.absolute().mkdir(parents=True, exist_ok=True)
+                data_array = ds[variable]
+                nodata_value = data_array.encoding.get('nodata', data_array.encoding.get('_FillValue'))
 
-                    data_array = ds[variable].isel(time=i)
-                    nodata_value = data_array.encoding.get('nodata', data_array.encoding.get('_FillValue'))
+                # convert the whole variable at once, evaluated lazily per time chunk on write
+                if var.get("convert"):
+                    convert_config = var.get("convert")
+                    data_array = self.convert_units(data_array, convert_config)
 
-                    if var.get("convert"):
-                        convert_config = var.get("convert")
-                        data_array = self.convert_units(data_array, convert_config)
+                # check that nodata is not nan
+                if np.isnan(nodata_value):
+                    data_array = data_array.rio.write_nodata(-9999, encoded=True)
 
-                    # check that nodata is not nan
-                    if np.isnan(nodata_value):
-                        data_array = data_array.rio.write_nodata(-9999, encoded=True)
+                write_tasks = [(data_array.isel(time=i), f"{file_prefix}{date_str}.tif")
+                               for i, date_str in enumerate(date_strs)]
 
-                    data_array.rio.to_raster(param_t_filename, driver="COG")
+                # write time slices concurrently
+                run_concurrently(self.save_time_slice, write_tasks)
 
         # remove downloaded file
+        ds.close()
         os.remove(temp_file)
 
         return True
+
+    @staticmethod
+    def save_time_slice(data_array, param_t_filename):
+        logging.debug(f"[DUST_FORECAST]: Saving {param_t_filename}")
+        data_array.rio.to_raster(param_t_filename, **COG_CREATION_OPTIONS)
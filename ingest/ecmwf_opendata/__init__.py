@@ -1,14 +1,20 @@
 import logging
 import os
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
-import pandas as pd
 import xarray as xr
 
-from ingest import DataIngest
+from ingest import DataIngest, GRIB_TO_NETCDF_ENGINE
 from ingest.ecmwf_opendata.client import ECWMFPatchedClient
+from ingest.utils import run_concurrently, format_time_values, open_grib_dataset, get_temp_dir, \
+    COG_CREATION_OPTIONS
+
+# one dask chunk per time step and pressure level, so each raster write only reads its own slice
+FORECAST_CHUNKS = {"time": 1, "plev": 1}
 
 SURFACE_LEVEL_PARAMS = [
     {
@@ -178,17 +184,37 @@ class ECMWFOpenData(DataIngest):
 
         self.client = ECWMFPatchedClient("ecmwf", beta=True)
 
+        # latest forecast dates checked during the current run
+        self.latest_dates = {}
+        self.latest_dates_lock = threading.Lock()
+
     def get_latest_date(self, request):
-        latest = self.client.latest(request, timeout=60, maximum_tries=4, retry_after=30)
-        return latest
+        # the forecast files of a cycle hold all level types, so the latest date only depends on the file urls
+        cache_key = (request.get("stream"), request.get("type"), request.get("time"), tuple(request.get("step")))
+
+        # surface and pressure data are retrieved concurrently, let the second one wait for the first lookup
+        with self.latest_dates_lock:
+            if cache_key not in self.latest_dates:
+                self.latest_dates[cache_key] = self.client.latest(request, timeout=60, maximum_tries=4,
+                                                                  retry_after=30)
+
+            return self.latest_dates[cache_key]
 
     def run(self):
+        # check the latest date afresh on each run
+        self.latest_dates = {}
 
-        # get surface data
-        latest_str = self.retrieve_surface_data()
+        # get surface and pressure levels data concurrently, overlapping the download of one with the processing
+        # of the other
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="ecmwf_retrieve") as executor:
+            surface_future = executor.submit(self.retrieve_surface_data)
+            pressure_future = executor.submit(self.retrieve_pressure_levels_data)
 
-        # get pressure levels data
-        latest_str = self.retrieve_pressure_levels_data()
+            surface_future.result()
+            latest_str = pressure_future.result()
+
+        # make sure all ingest commands went through
+        self.wait_for_ingest_commands()
 
         if latest_str:
             # update state
@@ -220,10 +246,10 @@ class ECMWFOpenData(DataIngest):
             logging.info(f'[ECMWF_FORECAST]: No Surface Data Update required. Skipping...')
             return
 
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
+        grib_file = self.create_temp_file(suffix=".grib2")
 
-        # update target file name
-        request.update({"target": temp_file.name})
+        # update target file name, and the date so that retrieve does not look up the latest date again
+        request.update({"target": grib_file, "date": latest})
 
         logging.info(f"[ECMWF_FORECAST]: Downloading Surface Data forecast for date: {latest}...")
         self.client.retrieve(request, timeout=1200)
@@ -232,7 +258,7 @@ class ECMWFOpenData(DataIngest):
         level_type = f"{request.get('levtype')}"
 
         self.process_surface_levels_data(
-            temp_file.name,
+            grib_file,
             file_prefix,
             level_type,
             latest_str
@@ -266,10 +292,10 @@ class ECMWFOpenData(DataIngest):
             logging.info(f'[ECMWF_FORECAST]: No Pressure Levels Data Update required. Skipping...')
             return
 
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
+        grib_file = self.create_temp_file(suffix=".grib2")
 
-        # update target file name
-        request.update({"target": temp_file.name})
+        # update target file name, and the date so that retrieve does not look up the latest date again
+        request.update({"target": grib_file, "date": latest})
 
         logging.info(f"[ECMWF_FORECAST]: Downloading Pressure Levels forecast data for date: {latest}...")
         self.client.retrieve(request, timeout=1200)
@@ -278,7 +304,7 @@ class ECMWFOpenData(DataIngest):
         level_type = f"{request.get('levtype')}"
 
         self.process_pressure_levels_data(
-            temp_file.name,
+            grib_file,
             file_prefix,
             level_type,
             latest_str
@@ -289,193 +315,206 @@ class ECMWFOpenData(DataIngest):
     def process_surface_levels_data(self, grib_file, file_prefix, level_type, latest_str):
         logging.info(f'[ECMWF_FORECAST]: Processing Surface Data for date: {latest_str}...')
 
-        # convert grib to netcdf
-        nc_file = self.grib_to_nc(grib_file)
+        # open data and write projection info, lazily with one dask chunk per time step and level
+        ds, data_file = self.open_forecast_dataset(grib_file)
+        ds.rio.write_crs("epsg:4326", inplace=True)
+
+        time_values = ds.time.values
+        date_strs = format_time_values(time_values)
+
+        # process each surface level param available in the data
+        for param, param_data_array in self.get_available_params(ds, self.surface_level_params):
+            param_name = param.get("name")
+            derived = param.get("derived")
+
+            namespace = f"{file_prefix}_{param_name}_{level_type}"
+            data_dir = f"{self.output_dir}/{namespace}"
+            # output filenames are the prefix followed by the date
+            file_name_prefix = f"{data_dir}/{namespace}_"
+            # create output directory if it does not exist
+            Path(data_dir).mkdir(parents=True, exist_ok=True)
+
+            wind_speed_all = None
+            if derived:
+                wind_speed_all = self.derive_wind_speed(ds, param.get("derived_config"))
+
+            # convert units for all time steps at once
+            var_data_array = param_data_array
+            convert_config = param.get("convert")
+            if not derived and convert_config:
+                var_data_array = self.convert_units(var_data_array, convert_config)
+
+            # process each timestamp
+            write_tasks = []
+            for i, (t, date_str) in enumerate(zip(time_values, date_strs)):
+                # output filename
+                param_t_filename = f"{file_name_prefix}{date_str}.tif"
+
+                if not derived:
+                    logging.info(f'[ECMWF_FORECAST]: Processing Surface Data param: {param_name} and time {t}')
+                    # get variable data for time
+                    data_array = var_data_array.isel(time=i)
+
+                    write_tasks.append((data_array, param_t_filename, date_str))
+                else:
+                    logging.info(
+                        f'[ECMWF_FORECAST]: Processing Derived Surface Data param: {param_name} and time {t}')
+                    # generate wind speed
+                    if wind_speed_all is not None:
+                        write_tasks.append((wind_speed_all.isel(time=i), param_t_filename, date_str))
+
+            # save data as geotiffs concurrently
+            self.save_rasters(write_tasks)
+
+            # generate vector data from param e.g contours
+            vectors_config = param.get("vectors")
+            if vectors_config:
+                for _, param_t_filename, date_str in write_tasks:
+                    self.handle_vector_generation(vectors_config, param_t_filename, namespace, date_str,
+                                                  latest_str)
 
-        # open nc and write projection info
-        ds = xr.open_dataset(nc_file)
+            # cleanup old forecasts before ingestion
+            self.cleanup_old_data(latest_str, data_dir)
+
+            # prepare ingestion payload
+            ingest_payload = self.get_ingest_payload(namespace, data_dir)
+            logging.info(f"[ECMWF_FORECAST]: Sending ingest command for namespace: {namespace}")
+
+            # send ingest command
+            self.dispatch_ingest_command(ingest_payload)
+
+        # close and delete the data file
+        ds.close()
+        os.remove(data_file)
+
+    def process_pressure_levels_data(self, grib_file, file_prefix, level_type, latest_str):
+        logging.info(f'[ECMWF_FORECAST]: Processing Pressure Levels Data for date: {latest_str}...')
+        # open data and write projection info, lazily with one dask chunk per time step and level
+        ds, data_file = self.open_forecast_dataset(grib_file)
         ds.rio.write_crs("epsg:4326", inplace=True)
 
-        # process each surface level param
-        for param in self.surface_level_params:
-            data_var = param.get("variable")
+        time_values = ds.time.values
+        date_strs = format_time_values(time_values)
+
+        # process each pressure level param available in the data
+        for param, param_data_array in self.get_available_params(ds, self.pressure_level_params):
             param_name = param.get("name")
             derived = param.get("derived")
 
-            if data_var in ds.variables:
-                namespace = f"{file_prefix}_{param_name}_{level_type}"
+            wind_speed_all = None
+            if derived:
+                wind_speed_all = self.derive_wind_speed(ds, param.get("derived_config"))
+
+            # convert units for all time steps and pressure levels at once
+            var_data_array = param_data_array
+            convert_config = param.get("convert")
+            if not derived and convert_config:
+                var_data_array = self.convert_units(var_data_array, convert_config)
+
+            # collect the writes of all pressure levels, so that they are saved as a single batch
+            levels_write_tasks = []
+
+            # process each pressure level
+            for p_index, p_lev in enumerate(ds.plev.values):
+                # convert to hPa
+                p_hpa = int(p_lev / 100)
+
+                namespace = f"{file_prefix}_{param_name}_{level_type}_{p_hpa}"
                 data_dir = f"{self.output_dir}/{namespace}"
+                file_name_prefix = f"{data_dir}/{namespace}_"
+                # create directory if not exists
+                Path(data_dir).mkdir(parents=True, exist_ok=True)
 
-                # process each timestamp
-                for i, t in enumerate(ds.time.values):
-                    data_datetime = pd.to_datetime(str(t))
-                    date_str = data_datetime.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-                    # output filename
-                    param_t_filename = f"{data_dir}/{namespace}_{date_str}.tif"
-                    # create output directory if it does not exist
-                    Path(param_t_filename).parent.absolute().mkdir(parents=True, exist_ok=True)
+                write_tasks = []
+                for time_index, (t, date_str) in enumerate(zip(time_values, date_strs)):
+                    param_p_filename = f"{file_name_prefix}{date_str}.tif"
 
                     if not derived:
-                        logging.info(f'[ECMWF_FORECAST]: Processing Surface Data param: {param_name} and time {t}')
-                        # get variable data for time
-                        data_array = ds[data_var].isel(time=i)
-
-                        convert_config = param.get("convert")
-                        if convert_config:
-                            data_array = self.convert_units(data_array, convert_config)
-
-                        # save data as geotiff
-                        data_array.rio.to_raster(param_t_filename, driver="COG")
-
-                        # generate vector data from param e.g contours
-                        vectors_config = param.get("vectors")
-                        if vectors_config:
-                            self.handle_vector_generation(vectors_config, param_t_filename, namespace, date_str,
-                                                          latest_str)
-                    else:
                         logging.info(
-                            f'[ECMWF_FORECAST]: Processing Derived Surface Data param: {param_name} and time {t}')
-                        derived_config = param.get("derived_config")
-                        derived_type = derived_config.get("type")
+                            f'[ECMWF_FORECAST]: Processing Pressure Levels Data for param param: {param_name}, time {t} PLevel: {p_hpa} hPa')
+                        # select data for time and pressure level
+                        data_array = var_data_array.isel(time=time_index, plev=p_index)
 
+                        write_tasks.append((data_array, param_p_filename, date_str))
+                    else:
+                        logging.info(
+                            f'[ECMWF_FORECAST]: Processing Derived Pressure Level Data for param: {param_name}, time {t}, PLevel: {p_hpa} hPa')
                         # generate wind speed
-                        if derived_type == "wind_speed":
-                            u_var = derived_config.get("u_var")
-                            v_var = derived_config.get("v_var")
-                            units = derived_config.get("units")
-
-                            if u_var in ds.variables and v_var in ds.variables:
-                                u_data = ds[u_var].isel(time=i)
-                                v_data = ds[v_var].isel(time=i)
-                                wind_speed = self.calculate_wind_speed(u_data, v_data)
+                        if wind_speed_all is not None:
+                            wind_speed = wind_speed_all.isel(time=time_index, plev=p_index)
+                            write_tasks.append((wind_speed, param_p_filename, date_str))
 
-                                if units:
-                                    wind_speed.attrs["units"] = units
+                levels_write_tasks.append((namespace, data_dir, write_tasks))
 
-                                logging.info(
-                                    f'[ECMWF_FORECAST]: Saving Surface Data Derived {param_t_filename}')
+            # save data for all pressure levels as geotiffs concurrently
+            self.save_rasters([task for _, _, write_tasks in levels_write_tasks for task in write_tasks])
 
-                                wind_speed.rio.to_raster(param_t_filename, driver="COG")
+            for namespace, data_dir, write_tasks in levels_write_tasks:
+                vectors_config = param.get("vectors")
+                if vectors_config:
+                    for _, param_p_filename, date_str in write_tasks:
+                        self.handle_vector_generation(vectors_config, param_p_filename, namespace, date_str,
+                                                      latest_str)
 
                 # cleanup old forecasts before ingestion
                 self.cleanup_old_data(latest_str, data_dir)
+                # prepare ingest payload
+                ingest_payload = self.get_ingest_payload(namespace, data_dir)
 
-                # prepare ingestion payload
-                ingest_payload = {
-                    "namespace": f"-n {namespace}",
-                    "path": f"-p {data_dir}",
-                    "datatype": "-t tif",
-                    "args": "-x -conf /rulesets/namespace_yyy-mm-ddTH.tif.json"
-                }
-                logging.info(f"[ECMWF_FORECAST]: Sending ingest command for namespace: {namespace}")
-
+                logging.info(
+                    f"[ECMWF_FORECAST]: Sending ingest command for namespace: {namespace}")
                 # send ingest command
-                self.send_ingest_command(ingest_payload)
-
-        # delete nc file
-        os.remove(nc_file)
-
-    def process_pressure_levels_data(self, grib_file, file_prefix, level_type, latest_str):
-        logging.info(f'[ECMWF_FORECAST]: Processing Pressure Levels Data for date: {latest_str}...')
-        # convert grib to netcdf
-        nc_file = self.grib_to_nc(grib_file)
+                self.dispatch_ingest_command(ingest_payload)
 
-        # open nc and write projection info
-        ds = xr.open_dataset(nc_file)
-        ds.rio.write_crs("epsg:4326", inplace=True)
+        # close and delete the data file
+        ds.close()
+        os.remove(data_file)
 
-        # process each pressure level param
-        for param in self.pressure_level_params:
-            data_var = param.get("variable")
-            param_name = param.get("name")
-            derived = param.get("derived")
-
-            if data_var in ds.variables:
-                # process each pressure level
-                for p_index, p_lev in enumerate(ds.plev.values):
-                    # convert to hPa
-                    p_hpa = int(p_lev / 100)
-
-                    namespace = f"{file_prefix}_{param_name}_{level_type}_{p_hpa}"
-                    data_dir = f"{self.output_dir}/{namespace}"
-
-                    for time_index, t in enumerate(ds.time.values):
-                        data_datetime = pd.to_datetime(str(t))
-                        date_str = data_datetime.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-
-                        param_p_filename = f"{data_dir}/{namespace}_{date_str}.tif"
-                        # create directory if not exists
-                        Path(param_p_filename).parent.absolute().mkdir(parents=True, exist_ok=True)
-
-                        if not derived:
-                            logging.info(
-                                f'[ECMWF_FORECAST]: Processing Pressure Levels Data for param param: {param_name}, time {t} PLevel: {p_hpa} hPa')
-                            # select data for time and pressure level
-                            data_array = ds[data_var].isel(time=time_index, plev=p_index)
-
-                            convert_config = param.get("convert")
-                            if convert_config:
-                                data_array = self.convert_units(data_array, convert_config)
-                            # save data as geotiff
-                            data_array.rio.to_raster(param_p_filename, driver="COG")
-
-                            vectors_config = param.get("vectors")
-                            if vectors_config:
-                                self.handle_vector_generation(vectors_config, param_p_filename, namespace, date_str,
-                                                              latest_str)
-                        else:
-                            logging.info(
-                                f'[ECMWF_FORECAST]: Processing Derived Pressure Level Data for param: {param_name}, time {t}, PLevel: {p_hpa} hPa')
-                            derived_config = param.get("derived_config")
-                            derived_type = derived_config.get("type")
-
-                            # generate wind speed
-                            if derived_type == "wind_speed":
-                                u_var = derived_config.get("u_var")
-                                v_var = derived_config.get("v_var")
-                                units = derived_config.get("units")
-
-                                if u_var in ds.variables and v_var in ds.variables:
-                                    u_data = ds[u_var].isel(time=time_index, plev=p_index)
-                                    v_data = ds[v_var].isel(time=time_index, plev=p_index)
-                                    wind_speed = self.calculate_wind_speed(u_data, v_data)
-
-                                    if units:
-                                        wind_speed.attrs["units"] = units
-
-                                    logging.info(
-                                        f'[ECMWF_FORECAST]: Saving Pressure Level Derived: {param_p_filename}')
-                                    wind_speed.rio.to_raster(param_p_filename, driver="COG")
-
-                    # cleanup old forecasts before ingestion
-                    self.cleanup_old_data(latest_str, data_dir)
-                    # prepare ingest payload
-                    ingest_payload = {
-                        "namespace": f"-n {namespace}",
-                        "path": f"-p {data_dir}",
-                        "datatype": "-t tif",
-                        "args": "-x -conf /rulesets/namespace_yyy-mm-ddTH.tif.json"
-                    }
+    @staticmethod
+    def get_available_params(ds, params):
+        # look up the data variable of each param once, skipping params not in the data
+        return [(param, ds[param.get("variable")]) for param in params if param.get("variable") in ds.variables]
 
-                    logging.info(
-                        f"[ECMWF_FORECAST]: Sending ingest command for namespace: {namespace}")
-                    # send ingest command
-                    self.send_ingest_command(ingest_payload)
+    def open_forecast_dataset(self, grib_file_path):
+        # read the GRIB directly with cfgrib, only going through a temporary netcdf file when using CDO
+        if GRIB_TO_NETCDF_ENGINE == "cdo":
+            nc_file = self.grib_to_nc(grib_file_path)
+            return xr.open_dataset(nc_file, chunks=FORECAST_CHUNKS), nc_file
 
-        # delete nc file
-        os.remove(nc_file)
+        logging.info(f"[ECMWF_FORECAST]: Reading grib data ...")
+        return open_grib_dataset(grib_file_path, chunks=FORECAST_CHUNKS), grib_file_path
 
     def grib_to_nc(self, grib_file_path):
         # convert to nc
-        nc_out_tmp = tempfile.NamedTemporaryFile(delete=False)
+        nc_out_tmp = self.create_temp_file(suffix=".nc")
 
         logging.info(f"[ECMWF_FORECAST]: Converting grib to nc ...")
-        self.grib_to_netcdf(grib_file_path, nc_out_tmp.name)
+        self.grib_to_netcdf(grib_file_path, nc_out_tmp)
 
         # delete grib file
         os.remove(grib_file_path)
 
-        return nc_out_tmp.name
+        return nc_out_tmp
+
+    @staticmethod
+    def create_temp_file(suffix=None):
+        # create a named temporary file and close its handle straight away, it is written to by path
+        fd, temp_file_path = tempfile.mkstemp(suffix=suffix, dir=get_temp_dir())
+        os.close(fd)
+        return temp_file_path
+
+    def save_rasters(self, write_tasks):
+        # write (data_array, filename, date_str) tasks concurrently, GDAL releases the GIL while writing
+        run_concurrently(self.save_raster, [(data_array, filename) for data_array, filename, _ in write_tasks])
+
+    @staticmethod
+    def save_raster(data_array, filename):
+        logging.info(f'[ECMWF_FORECAST]: Saving {filename}')
+        # materialize just this slice in the calling worker thread, writes are already run concurrently
+        data_array = data_array.compute(scheduler="synchronous")
+        # write as float32, unit conversions may have promoted the data to float64
+        data_array = data_array.astype(np.float32, copy=False)
+        data_array.rio.to_raster(filename, **COG_CREATION_OPTIONS)
 
     def handle_vector_generation(self, vectors_config, param_t_filename, namespace, date_str, latest_date_str):
         for vector_config in vectors_config:
@@ -492,6 +531,27 @@ class ECMWFOpenData(DataIngest):
                 self.create_contour_data(param_t_filename, self.vector_db_conn_conn_params,
                                          date_str, namespace, attr_name, interval, latest_date_str=latest_date_str)
 
+    def derive_wind_speed(self, ds, derived_config):
+        # wind speed for all time steps and levels at once
+        if derived_config.get("type") != "wind_speed":
+            return None
+
+        u_var = derived_config.get("u_var")
+        v_var = derived_config.get("v_var")
+        units = derived_config.get("units")
+
+        if u_var not in ds.variables or v_var not in ds.variables:
+            return None
+
+        wind_speed = self.calculate_wind_speed(ds[u_var], ds[v_var])
+
+        if units:
+            wind_speed.attrs["units"] = units
+
+        return wind_speed
+
     @staticmethod
     def calculate_wind_speed(u_data, v_data):
-        return np.sqrt(u_data ** 2 + v_data ** 2)
+        # hypot computes sqrt(u**2 + v**2) in a single pass without temporary arrays
+        wind_speed = xr.apply_ufunc(np.hypot, u_data, v_data, dask="parallelized", output_dtypes=[np.float32])
+        return wind_speed.astype(np.float32)
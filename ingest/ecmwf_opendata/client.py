@@ -1,17 +1,60 @@
 import itertools
 import json
+import logging
 import os
-from collections import defaultdict
+import threading
+import time
+from collections import defaultdict, OrderedDict
+from concurrent.futures import Future
 
 from ecmwf.opendata import Client
 from ecmwf.opendata.client import PATTERNS, HOURLY_PATTERN, EXTENSIONS, Result, warning_once
 from ecmwf.opendata.date import full_date
 from multiurl import download, robust
-import requests
+from requests.exceptions import ChunkedEncodingError, HTTPError
 import datetime
 
+from ingest.utils import run_concurrently, create_http_session, DOWNLOAD_CHUNK_SIZE, REQUESTS_TIMEOUT
+
+# number of concurrent requests when probing the forecast files or fetching their indexes
+HTTP_WORKERS = 16
+# number of step files downloaded at once by retrieve
+DOWNLOAD_WORKERS = 8
+
+
+def merge_ranges(ranges):
+    # join (offset, length) byte ranges that follow each other, keeping their order
+    merged = []
+    for offset, length in ranges:
+        if merged and merged[-1][0] + merged[-1][1] == offset:
+            merged[-1] = (merged[-1][0], merged[-1][1] + length)
+        else:
+            merged.append((offset, length))
+    return merged
+
+# number of parsed index files kept in memory, a few forecast cycles worth of step files
+INDEX_CACHE_SIZE = 256
+# number of step file urls remembered as available before the record is reset
+AVAILABLE_URLS_MAX_SIZE = 1024
+
 
 class ECWMFPatchedClient(Client):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # keep-alive connections to the data server, shared by the concurrent probes, index fetches and downloads.
+        # Retries are left to robust()
+        self.session = create_http_session(pool_connections=4, pool_maxsize=HTTP_WORKERS, max_retries=0)
+
+        # step files already found to be published. Between cycles every run falls back to the previous cycle,
+        # whose files do not need probing again
+        self.available_urls = set()
+
+        # parsed index entries by index url, most recently used last. Each value is the future of the fetch,
+        # so that concurrent requests for the same index share a single download
+        self.index_cache = OrderedDict()
+        self.index_cache_lock = threading.Lock()
+
     def download(self, request=None, target=None, timeout=None, **kwargs):
         result = self._get_urls(request, target=target, use_index=False, **kwargs)
         result.size = download(result.urls, target=result.target, timeout=timeout)
@@ -19,9 +62,77 @@ class ECWMFPatchedClient(Client):
 
     def retrieve(self, request=None, target=None, timeout=None, **kwargs):
         result = self._get_urls(request, target=target, use_index=True, **kwargs)
-        result.size = download(result.urls, target=result.target, timeout=None)
+        result.size = self.download_concurrently(result.urls, target=result.target, timeout=timeout)
         return result
 
+    def download_concurrently(self, urls, target, timeout=None):
+        # a stalled connection must not hang a download worker forever
+        timeout = timeout or REQUESTS_TIMEOUT
+
+        # without an index the size of each file is not known up front, download them one after another
+        if not all(isinstance(url, tuple) for url in urls):
+            return download(urls, target=target, timeout=timeout)
+
+        # each step file's ranges go straight into the target at the offset they would have in a sequential
+        # download, so the GRIB is the same and no part files are copied
+        download_tasks = []
+        size = 0
+        for url, ranges in urls:
+            download_tasks.append((url, merge_ranges(ranges), target, size, timeout))
+            size += sum(length for _, length in ranges)
+
+        with open(target, "wb") as f:
+            f.truncate(size)
+
+        try:
+            run_concurrently(self.download_ranges, download_tasks, max_workers=DOWNLOAD_WORKERS)
+        except Exception:
+            # do not leave partial downloads behind
+            os.remove(target)
+            raise
+
+        return size
+
+    def download_ranges(self, url, ranges, target, offset, timeout=REQUESTS_TIMEOUT, maximum_tries=10,
+                        retry_after=120):
+        with open(target, "r+b") as f:
+            for start, length in ranges:
+                # robust() only retries opening the request. A connection dropped or a short body while
+                # streaming is retried here, writing the range again from its offset in the target
+                for tries in range(1, maximum_tries + 1):
+                    try:
+                        self.download_range(f, offset, url, start, length, timeout, maximum_tries, retry_after)
+                        break
+                    except HTTPError:
+                        raise
+                    except (IOError, ChunkedEncodingError) as e:
+                        if tries == maximum_tries:
+                            raise
+                        logging.warning(f"[ECMWF_FORECAST]: Range {start}-{start + length - 1} of {url} failed: {e}. "
+                                        f"Retrying in {retry_after}s ({tries}/{maximum_tries})")
+                        time.sleep(retry_after)
+
+                offset += length
+
+    def download_range(self, f, offset, url, start, length, timeout=REQUESTS_TIMEOUT, maximum_tries=10,
+                       retry_after=120):
+        f.seek(offset)
+
+        headers = {"Range": f"bytes={start}-{start + length - 1}"}
+        get = robust(self.session.get, maximum_tries=maximum_tries, retry_after=retry_after)
+        with get(url, headers=headers, stream=True, timeout=timeout) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise ValueError(f"Byte range requests not supported for {url}")
+
+            written = 0
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+
+        if written != length:
+            raise IOError(f"Expected {length} bytes from {url} at {start}, got {written}")
+
     def latest(self, request=None, timeout=None, maximum_tries=10, retry_after=120, **kwargs):
         if request is None:
             params = dict(**kwargs)
@@ -47,15 +158,27 @@ class ECWMFPatchedClient(Client):
                 retry_after=retry_after,
                 **params,
             )
-            codes = [robust(requests.head, maximum_tries=maximum_tries,
-                            retry_after=retry_after)(url, timeout=timeout).status_code for url in result.urls]
-
-            if len(codes) > 0 and all(c == 200 for c in codes):
+            # probe all files of the date not yet known to be available concurrently,
+            # each probe is a single network round trip
+            probe_urls = [url for url in result.urls if url not in self.available_urls]
+            codes = run_concurrently(self.head_status_code,
+                                     [(url, timeout, maximum_tries, retry_after) for url in probe_urls],
+                                     max_workers=HTTP_WORKERS)
+
+            if len(result.urls) > 0 and all(c == 200 for c in codes):
+                if len(self.available_urls) > AVAILABLE_URLS_MAX_SIZE:
+                    self.available_urls.clear()
+                self.available_urls.update(result.urls)
                 return date
             date -= delta
 
         raise ValueError("Cannot etablish latest date for %r" % (result.for_urls,))
 
+    def head_status_code(self, url, timeout=None, maximum_tries=10, retry_after=120):
+        response = robust(self.session.head, maximum_tries=maximum_tries, retry_after=retry_after)(url,
+                                                                                                 timeout=timeout)
+        return response.status_code
+
     def _get_urls(self, request=None, use_index=None, target=None, timeout=None, maximum_tries=10, retry_after=120,
                   **kwargs):
         assert use_index in (True, False)
@@ -79,15 +202,22 @@ class ECWMFPatchedClient(Client):
 
         dates = set()
 
-        for args in (
-                dict(zip(for_urls.keys(), x)) for x in itertools.product(*for_urls.values())
-        ):
+        # every step of a request shares the same few dates, format each (date, time) pair only once
+        date_parts = {}
+
+        url_keys = list(for_urls.keys())
+        for values in itertools.product(*for_urls.values()):
+            args = dict(zip(url_keys, values))
             pattern = PATTERNS.get(args["stream"], HOURLY_PATTERN)
-            date = full_date(args.pop("date", None), args.pop("time", None))
+
+            date_key = (args.pop("date", None), args.pop("time", None))
+            if date_key not in date_parts:
+                date = full_date(*date_key)
+                date_parts[date_key] = (date, date.strftime("%Y%m%d"), date.strftime("%H"),
+                                        date.strftime("%Y%m%d%H%M%S"))
+
+            date, args["_yyyymmdd"], args["_H"], args["_yyyymmddHHMMSS"] = date_parts[date_key]
             dates.add(date)
-            args["_yyyymmdd"] = date.strftime("%Y%m%d")
-            args["_H"] = date.strftime("%H")
-            args["_yyyymmddHHMMSS"] = date.strftime("%Y%m%d%H%M%S")
             args["_extension"] = EXTENSIONS.get(args["type"], "grib2")
             args["_stream"] = self.patch_stream(args)
 
@@ -110,36 +240,26 @@ class ECWMFPatchedClient(Client):
 
     def get_parts(self, data_urls, for_index, timeout=None, maximum_tries=10, retry_after=120):
 
-        count = len(for_index)
         result = []
-        line = None
 
         possible_values = defaultdict(set)
 
-        for url in data_urls:
-            base, _ = os.path.splitext(url)
-            index_url = f"{base}.index"
-            r = robust(requests.get, maximum_tries=maximum_tries, retry_after=retry_after)(index_url, timeout=timeout)
-            r.raise_for_status()
+        # positions of every requested value for each index key, so index lines are matched with a dict lookup
+        # instead of scanning the requested values
+        value_positions = []
+        for i, (name, values) in enumerate(for_index.items()):
+            positions = defaultdict(list)
+            for j, v in enumerate(values):
+                positions[v].append(j)
+            value_positions.append((i, name, dict(positions)))
 
-            parts = []
-            for line in r.iter_lines():
-                line = json.loads(line)
-                matches = []
-                for i, (name, values) in enumerate(for_index.items()):
-                    idx = line.get(name)
-                    if idx is not None:
-                        possible_values[name].add(idx)
-                    if idx in values:
-                        if self.preserve_request_order:
-                            for j, v in enumerate(values):
-                                if v == idx:
-                                    matches.append((i, j))
-                        else:
-                            matches.append(line["_offset"])
-
-                if len(matches) == count:
-                    parts.append((tuple(matches), (line["_offset"], line["_length"])))
+        # fetch and parse the index of every file concurrently, results keep the order of data_urls
+        index_tasks = [(url, value_positions, timeout, maximum_tries, retry_after) for url in data_urls]
+        urls_index_parts = run_concurrently(self.get_index_parts, index_tasks, max_workers=HTTP_WORKERS)
+
+        for url, (parts, url_possible_values) in zip(data_urls, urls_index_parts):
+            for name, values in url_possible_values.items():
+                possible_values[name].update(values)
 
             if parts:
                 result.append((url, tuple(p[1] for p in sorted(parts))))
@@ -158,3 +278,67 @@ class ECWMFPatchedClient(Client):
             raise ValueError("Cannot find index entries matching %r" % (for_index,))
 
         return result
+
+    def get_index_parts(self, url, value_positions, timeout=None, maximum_tries=10, retry_after=120):
+        count = len(value_positions)
+
+        base, _ = os.path.splitext(url)
+        index_url = f"{base}.index"
+
+        parts = []
+        possible_values = defaultdict(set)
+
+        for line in self.get_index_lines(index_url, timeout, maximum_tries, retry_after):
+            matches = []
+            for i, name, positions in value_positions:
+                idx = line.get(name)
+                if idx is not None:
+                    possible_values[name].add(idx)
+                idx_positions = positions.get(idx)
+                if idx_positions:
+                    if self.preserve_request_order:
+                        matches.extend((i, j) for j in idx_positions)
+                    else:
+                        matches.append(line["_offset"])
+
+            if len(matches) == count:
+                parts.append((tuple(matches), (line["_offset"], line["_length"])))
+
+        return parts, possible_values
+
+    def get_index_lines(self, index_url, timeout=None, maximum_tries=10, retry_after=120):
+        # the index of a published step file does not change, and the surface and pressure levels requests
+        # read the same step files, often at the same time. Keep the parsed entries in memory,
+        # failed requests are not cached
+        with self.index_cache_lock:
+            future = self.index_cache.get(index_url)
+            fetch = future is None
+            if fetch:
+                future = Future()
+                self.index_cache[index_url] = future
+                if len(self.index_cache) > INDEX_CACHE_SIZE:
+                    self.index_cache.popitem(last=False)
+            else:
+                self.index_cache.move_to_end(index_url)
+
+        if not fetch:
+            # fetched, or being fetched by another thread
+            return future.result()
+
+        try:
+            future.set_result(self.fetch_index_lines(index_url, timeout, maximum_tries, retry_after))
+        except Exception as e:
+            with self.index_cache_lock:
+                if self.index_cache.get(index_url) is future:
+                    del self.index_cache[index_url]
+            future.set_exception(e)
+
+        return future.result()
+
+    def fetch_index_lines(self, index_url, timeout=None, maximum_tries=10, retry_after=120):
+        r = robust(self.session.get, maximum_tries=maximum_tries, retry_after=retry_after)(index_url, timeout=timeout)
+        r.raise_for_status()
+
+        # index files are small, split the whole body at once instead of re-chunking it with iter_lines.
+        # json.loads reads the utf-8 bytes directly
+        return tuple(json.loads(line) for line in r.content.splitlines() if line)
@@ -14,3 +14,7 @@ class UnknownDataConvertOperation(Error):
 
 class UnKnownGeomType(Error):
     pass
+
+
+class ContourGenerationError(Error):
+    pass
@@ -1,34 +1,52 @@
-from ingest.cams_forecast import CamsForecast
-from ingest.chirps_rainfall import ChirpsRainfall
+import functools
+import importlib
+
 from config import SETTINGS
-from ingest.dustforecast import DustForecastIngest
-from ingest.ecmwf_opendata import ECMWFOpenData
-from ingest.tamsat_rainfall import TamSatRainfall
 
-dust_forecast = DustForecastIngest(dataset_id="dust_forecast",
-                                   output_dir=SETTINGS.get("DUST_FORECAST_DATA_DIR"),
-                                   username=SETTINGS.get("DUST_AEMET_USERNAME"),
-                                   password=SETTINGS.get("DUST_AEMET_PASSWORD"))
 
-ecmwf_forecast = ECMWFOpenData(dataset_id="ecmwf_forecast",
-                               output_dir=SETTINGS.get("ECMWF_FORECAST_DATA_DIR"),
-                               vector_db_conn_conn_params=SETTINGS.get("VECTOR_DB_CONN_PARAMS"))
+def lazy_ingest_job(module_name, class_name, **kwargs):
+    """Job that imports and creates its dataset ingest on the first run, so only scheduled datasets are loaded"""
+
+    @functools.lru_cache(maxsize=None)
+    def get_ingest():
+        ingest_class = getattr(importlib.import_module(module_name), class_name)
+        return ingest_class(**kwargs)
+
+    def run():
+        return get_ingest().run()
+
+    return run
+
+
+dust_forecast = lazy_ingest_job("ingest.dustforecast", "DustForecastIngest",
+                                dataset_id="dust_forecast",
+                                output_dir=SETTINGS.get("DUST_FORECAST_DATA_DIR"),
+                                username=SETTINGS.get("DUST_AEMET_USERNAME"),
+                                password=SETTINGS.get("DUST_AEMET_PASSWORD"))
+
+ecmwf_forecast = lazy_ingest_job("ingest.ecmwf_opendata", "ECMWFOpenData",
+                                 dataset_id="ecmwf_forecast",
+                                 output_dir=SETTINGS.get("ECMWF_FORECAST_DATA_DIR"),
+                                 vector_db_conn_conn_params=SETTINGS.get("VECTOR_DB_CONN_PARAMS"))
 
-tamsat_rainfall_estimate = TamSatRainfall(dataset_id="tamsat_rainfall",
-                                          output_dir=SETTINGS.get("TAMSAT_RAINFALL_DATA_DIR"), )
+tamsat_rainfall_estimate = lazy_ingest_job("ingest.tamsat_rainfall", "TamSatRainfall",
+                                           dataset_id="tamsat_rainfall",
+                                           output_dir=SETTINGS.get("TAMSAT_RAINFALL_DATA_DIR"), )
 
-chirps_rainfall_estimate = ChirpsRainfall(dataset_id="chirps_rainfall",
-                                          output_dir=SETTINGS.get("CHIRPS_RAINFALL_DATA_DIR"))
+chirps_rainfall_estimate = lazy_ingest_job("ingest.chirps_rainfall", "ChirpsRainfall",
+                                           dataset_id="chirps_rainfall",
+                                           output_dir=SETTINGS.get("CHIRPS_RAINFALL_DATA_DIR"))
 
-cams_forecast = CamsForecast(dataset_id="cams_forecast",
-                             output_dir=SETTINGS.get("CAMS_FORECAST_DATA_DIR"),
-                             api_key=SETTINGS.get("CAMS_API_KEY"))
+cams_forecast = lazy_ingest_job("ingest.cams_forecast", "CamsForecast",
+                                dataset_id="cams_forecast",
+                                output_dir=SETTINGS.get("CAMS_FORECAST_DATA_DIR"),
+                                api_key=SETTINGS.get("CAMS_API_KEY"))
 
 # Jobs
 jobs = [
     {
-        "job": dust_forecast.run,
-        "id": dust_forecast.dataset_id,
+        "job": dust_forecast,
+        "id": "dust_forecast",
         "enabled": True,
         "options": {
             'trigger': "interval", "seconds": int(SETTINGS.get("DUST_FORECAST_UPDATE_INTERVAL_SECONDS")),
@@ -36,8 +54,8 @@ jobs = [
         }
     },
     {
-        "job": ecmwf_forecast.run,
-        "id": ecmwf_forecast.dataset_id,
+        "job": ecmwf_forecast,
+        "id": "ecmwf_forecast",
         "enabled": True,
         "options": {
             'trigger': "interval", "seconds": int(SETTINGS.get("ECMWF_FORECAST_UPDATE_INTERVAL_SECONDS")),
@@ -45,8 +63,8 @@ jobs = [
         }
     },
     {
-        "job": tamsat_rainfall_estimate.run,
-        "id": tamsat_rainfall_estimate.dataset_id,
+        "job": tamsat_rainfall_estimate,
+        "id": "tamsat_rainfall",
         "enabled": True,
         "options": {
             'trigger': "interval", "seconds": int(SETTINGS.get("TAMSAT_RAINFALL_UPDATE_INTERVAL_SECONDS")),
@@ -54,8 +72,8 @@ jobs = [
         }
     },
     {
-        "job": chirps_rainfall_estimate.run,
-        "id": chirps_rainfall_estimate.dataset_id,
+        "job": chirps_rainfall_estimate,
+        "id": "chirps_rainfall",
         "enabled": True,
         "options": {
             'trigger': "interval", "seconds": int(SETTINGS.get("CHIRPS_RAINFALL_UPDATE_INTERVAL_SECONDS")),
@@ -63,8 +81,8 @@ jobs = [
         }
     },
     {
-        "job": cams_forecast.run,
-        "id": cams_forecast.dataset_id,
+        "job": cams_forecast,
+        "id": "cams_forecast",
         "enabled": True,
         "options": {
             'trigger': "interval", "seconds": int(SETTINGS.get("CAMS_FORECAST_UPDATE_INTERVAL_SECONDS")),
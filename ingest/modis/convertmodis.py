@@ -1,6 +1,11 @@
+import functools
+import io
+import os
 import tempfile
 from collections import OrderedDict
 
+import numpy as np
+
 try:
     from slugify import slugify
 except ImportError:
@@ -33,6 +38,26 @@ SINU_WKT = 'PROJCS["Sinusoidal_Sanson_Flamsteed",GEOGCS["GCS_Unknown",' \
            ',PROJECTION["Sinusoidal"],PARAMETER["central_meridian",0],' \
            'PARAMETER["false_easting",0],PARAMETER["false_northing",0]' \
            ',UNIT["Meter",1]]'
+# smallest number of pixels copied at once, scanline blocks are grouped
+# into strips of at least this size
+COPY_BLOCK_PIXELS = 512 * 512
+# VRT complex source, formatted once per tile and band
+COMPLEX_SOURCE_VRT = ('\t\t<ComplexSource>\n'
+                      '\t\t\t<SourceFilename relativeToVRT="0">%(name)s'
+                      '</SourceFilename>\n'
+                      '\t\t\t<SourceBand>%(band)d</SourceBand>\n'
+                      '\t\t\t<SourceProperties RasterXSize="%(x)d" '
+                      'RasterYSize="%(y)d" DataType="%(typ)s" '
+                      'BlockXSize="%(bx)d" BlockYSize="%(by)d" />\n'
+                      '\t\t\t<SrcRect xOff="0" yOff="0" xSize="%(x)d" '
+                      'ySize="%(y)d" />\n'
+                      '\t\t\t<DstRect xOff="%(xoff)d" yOff="%(yoff)d" '
+                      'xSize="%(x)d" ySize="%(y)d" />\n'
+                      '%(nodata)s'
+                      '\t\t</ComplexSource>\n')
+GTIFF_CREATION_OPTIONS = ['NUM_THREADS=ALL_CPUS', 'TILED=YES',
+                          'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
+                          'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER']
 
 
 def getResampling(res):
@@ -57,52 +82,98 @@ def getResampling(res):
 
 
 # =============================================================================
+@functools.lru_cache(maxsize=256)
+def _open_ds(filename):
+    """Open a GDAL dataset, reusing the handle of files already opened.
+    Shared by the whole process, see CreateMosaicGDAL"""
+    return gdal.Open(filename)
+
+
+def copy_blocks(s_xoff, s_yoff, s_xsize, s_ysize,
+                t_xoff, t_yoff, t_xsize, t_ysize, block_size):
+    """Split a copy into blocks of the given size, yielding the matching
+    (xoff, yoff, xsize, ysize) source and target windows of each block.
+    """
+    bx, by = block_size
+    bx = min(bx, t_xsize)
+    by = max(by, -(-COPY_BLOCK_PIXELS // bx))
+
+    for y0 in range(0, t_ysize, by):
+        y1 = min(y0 + by, t_ysize)
+        sy0 = y0 * s_ysize // t_ysize
+        sy1 = max(y1 * s_ysize // t_ysize, sy0 + 1)
+        for x0 in range(0, t_xsize, bx):
+            x1 = min(x0 + bx, t_xsize)
+            sx0 = x0 * s_xsize // t_xsize
+            sx1 = max(x1 * s_xsize // t_xsize, sx0 + 1)
+            yield ((s_xoff + sx0, s_yoff + sy0, sx1 - sx0, sy1 - sy0),
+                   (t_xoff + x0, t_yoff + y0, x1 - x0, y1 - y0))
+
+
+def nodata_mask(data, nodata):
+    """Return a boolean mask of the valid values of data. An integral nodata
+    is compared in the integer dtype of data, not promoted to float64.
+    """
+    if np.issubdtype(data.dtype, np.integer) and float(nodata).is_integer():
+        info = np.iinfo(data.dtype)
+        if info.min <= nodata <= info.max:
+            nodata = data.dtype.type(nodata)
+    return np.not_equal(data, nodata, dtype=np.bool_)
+
+
 def raster_copy(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
                 t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
-                nodata=None):
-    """Copy a band of raster into the output file.
+                nodata=None, block_size=None):
+    """Copy a band of raster into the output file, one block at a time.
 
        Function copied from gdal_merge.py
+
+       :param tuple block_size: (xsize, ysize) of the blocks to copy, the
+                                target band block size if not given
     """
     if nodata is not None:
         return raster_copy_with_nodata(s_fh, s_xoff, s_yoff, s_xsize, s_ysize,
                                        s_band_n, t_fh, t_xoff, t_yoff, t_xsize,
-                                       t_ysize, t_band_n, nodata)
+                                       t_ysize, t_band_n, nodata, block_size)
 
     s_band = s_fh.GetRasterBand(s_band_n)
     t_band = t_fh.GetRasterBand(t_band_n)
 
-    data = s_band.ReadRaster(s_xoff, s_yoff, s_xsize, s_ysize,
-                             t_xsize, t_ysize, t_band.DataType)
-    t_band.WriteRaster(t_xoff, t_yoff, t_xsize, t_ysize, data, t_xsize,
-                       t_ysize, t_band.DataType)
+    for s_window, t_window in copy_blocks(s_xoff, s_yoff, s_xsize, s_ysize,
+                                          t_xoff, t_yoff, t_xsize, t_ysize,
+                                          block_size or t_band.GetBlockSize()):
+        bt_xoff, bt_yoff, bt_xsize, bt_ysize = t_window
+        data = s_band.ReadRaster(*s_window, bt_xsize, bt_ysize,
+                                 t_band.DataType)
+        t_band.WriteRaster(bt_xoff, bt_yoff, bt_xsize, bt_ysize, data,
+                           bt_xsize, bt_ysize, t_band.DataType)
 
     return 0
 
 
 def raster_copy_with_nodata(s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
                             t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
-                            nodata):
-    """Copy a band of raster into the output file with nodata values.
+                            nodata, block_size=None):
+    """Copy a band of raster into the output file with nodata values, one
+    block at a time.
 
        Function copied from gdal_merge.py
     """
-    try:
-        import numpy as Numeric
-    except ImportError:
-        import Numeric
-
     s_band = s_fh.GetRasterBand(s_band_n)
     t_band = t_fh.GetRasterBand(t_band_n)
 
-    data_src = s_band.ReadAsArray(s_xoff, s_yoff, s_xsize, s_ysize,
-                                  t_xsize, t_ysize)
-    data_dst = t_band.ReadAsArray(t_xoff, t_yoff, t_xsize, t_ysize)
+    for s_window, t_window in copy_blocks(s_xoff, s_yoff, s_xsize, s_ysize,
+                                          t_xoff, t_yoff, t_xsize, t_ysize,
+                                          block_size or t_band.GetBlockSize()):
+        bt_xoff, bt_yoff, bt_xsize, bt_ysize = t_window
+        data_src = s_band.ReadAsArray(*s_window, bt_xsize, bt_ysize)
+        data_dst = t_band.ReadAsArray(*t_window)
 
-    nodata_test = Numeric.equal(data_src, nodata)
-    to_write = Numeric.choose(nodata_test, (data_src, data_dst))
+        # keep the output values where the source is nodata, in place
+        np.copyto(data_dst, data_src, casting="unsafe",
+                  where=nodata_mask(data_src, nodata))
 
-    t_band.WriteArray(to_write, t_xoff, t_yoff)
+        t_band.WriteArray(data_dst, bt_xoff, bt_yoff)
 
     return 0
 
@@ -119,7 +190,7 @@ class FileInfo:
 
     def init_from_name(self, filename):
         """Initialize file_info from filename"""
-        fh = gdal.Open(filename)
+        fh = _open_ds(filename)
         if fh is None:
             return 0
 
@@ -152,26 +223,12 @@ class FileInfo:
 
         return 1
 
-    def copy_into(self, t_fh, s_band=1, t_band=1, nodata_arg=None):
-        """Copy this files image into target file.
-
-        This method will compute the overlap area of the file_info objects
-        file, and the target gdal.Dataset object, and copy the image data
-        for the common window area.  It is assumed that the files are in
-        a compatible projection. no checking or warping is done.  However,
-        if the destination file is a different resolution, or different
-        image pixel type, the appropriate resampling and conversions will
-        be done (using normal GDAL promotion/demotion rules).
-
-        :param t_fh: gdal.Dataset object for the file into which some or all
-                     of this file may be copied.
-        :param s_band:
-        :param t_band:
-        :param nodata_arg:
-
-        :return: 1 on success (or if nothing needs to be copied), and zero one
-                 failure.
+    def copy_windows(self, t_fh):
+        """Return the (xoff, yoff, xsize, ysize) source and target windows
+        of the area this file shares with the target file, or None if there
+        is nothing to copy.
 
+        :param t_fh: gdal.Dataset object for the target file
         """
         t_geotransform = t_fh.GetGeoTransform()
         t_ulx = t_geotransform[0]
@@ -191,11 +248,11 @@ class FileInfo:
 
         # do they even intersect?
         if tgw_ulx >= tgw_lrx:
-            return 1
+            return None
         if t_geotransform[5] < 0 and tgw_uly <= tgw_lry:
-            return 1
+            return None
         if t_geotransform[5] > 0 and tgw_uly >= tgw_lry:
-            return 1
+            return None
 
         # compute target window in pixel coordinates.
         tw_xoff = int((tgw_ulx - t_geotransform[0]) / t_geotransform[1] + 0.1)
@@ -204,7 +261,7 @@ class FileInfo:
         tw_ysize = int((tgw_lry - t_geotransform[3]) / t_geotransform[5] + 0.5) - tw_yoff
 
         if tw_xsize < 1 or tw_ysize < 1:
-            return 1
+            return None
 
         # Compute source window in pixel coordinates.
         sw_xoff = int((tgw_ulx - self.geotransform[0]) / self.geotransform[1])
@@ -214,16 +271,55 @@ class FileInfo:
         sw_ysize = int((tgw_lry - self.geotransform[3])
                        / self.geotransform[5] + 0.5) - sw_yoff
 
+        # same pixel size, read the window as is so GDAL does not resample
+        if self.geotransform[1] == t_geotransform[1] and \
+                self.geotransform[5] == t_geotransform[5]:
+            sw_xsize, sw_ysize = tw_xsize, tw_ysize
+
         if sw_xsize < 1 or sw_ysize < 1:
+            return None
+
+        return ((sw_xoff, sw_yoff, sw_xsize, sw_ysize),
+                (tw_xoff, tw_yoff, tw_xsize, tw_ysize))
+
+    def copy_into(self, t_fh, s_band=1, t_band=1, nodata_arg=None,
+                  block_size=None):
+        """Copy this files image into target file.
+
+        This method will compute the overlap area of the file_info objects
+        file, and the target gdal.Dataset object, and copy the image data
+        for the common window area.  It is assumed that the files are in
+        a compatible projection. no checking or warping is done.  However,
+        if the destination file is a different resolution, or different
+        image pixel type, the appropriate resampling and conversions will
+        be done (using normal GDAL promotion/demotion rules).
+
+        :param t_fh: gdal.Dataset object for the file into which some or all
+                     of this file may be copied.
+        :param s_band:
+        :param t_band:
+        :param nodata_arg:
+        :param block_size: (xsize, ysize) of the blocks to copy, the block
+                           size of this file if not given
+
+        :return: 1 on success (or if nothing needs to be copied), and zero one
+                 failure.
+
+        """
+        windows = self.copy_windows(t_fh)
+        if windows is None:
             return 1
 
+        (sw_xoff, sw_yoff, sw_xsize, sw_ysize), \
+            (tw_xoff, tw_yoff, tw_xsize, tw_ysize) = windows
+
         # Open the source file, and copy the selected region.
-        s_fh = gdal.Open(self.filename)
+        s_fh = _open_ds(self.filename)
 
         return \
             raster_copy(s_fh, sw_xoff, sw_yoff, sw_xsize, sw_ysize, s_band,
                         t_fh, tw_xoff, tw_yoff, tw_xsize, tw_ysize, t_band,
-                        nodata_arg)
+                        nodata_arg, block_size or self.block_size)
 
 
 class CreateMosaicGDAL:
@@ -235,6 +331,11 @@ class CreateMosaicGDAL:
                              not used for the VRT output, supported values
                              are HDF4Image, GTiff, HFA, and maybe something
                              else not tested.
+
+       Input files are opened through the module wide _open_ds cache, which
+       run clears when it returns. Only one mosaic may be
+       created at a time in a process, do not use this class from several
+       threads at once.
     """
 
     def __init__(self, hdf_names, subset=None, out_format="GTiff"):
@@ -266,61 +367,51 @@ class CreateMosaicGDAL:
                             ' piecewise writing.\nPlease select a format that'
                             ' does, such as GTiff (the default) or HFA (Erdas'
                             ' Imagine).' % format)
-        self._init_layers()
-        self._get_used_layers()
-        self._names_to_file_infos()
-
-    def _init_layers(self):
-        """Set up the variable self.layers as dictionary for each chosen
-        subset"""
-        if isinstance(self.in_names, list):
-            src_ds = gdal.Open(self.in_names[0])
-        else:
+        self._new_size = None
+        self._scan_inputs()
+
+    def _scan_inputs(self):
+        """Set up self.layers, the subdatasets of each chosen subset, and
+        self.file_infos, their file_info objects, in one pass over the input
+        files. There may be less file_info objects than subdatasets if some
+        of them could not be opened as GDAL files.
+        """
+        if not isinstance(self.in_names, list):
             raise Exception("The input value should be a list of HDF files")
-        layers = src_ds.GetSubDatasets()
-        self.layers = OrderedDict()
 
-        if not self.subset:
-            self.subset = [1 for i in range(len(layers))]
+        self.layers = OrderedDict()
+        self.file_infos = OrderedDict()
 
-        for i, sub in enumerate(self.subset):
-            name = layers[i][0].split(':')[-1].strip('"')
-            sub = str(sub)
-            if sub == name or sub == '1':
-                self.layers[name] = list()
+        for n, in_name in enumerate(self.in_names):
+            layers = _open_ds(in_name).GetSubDatasets()
 
-    def _get_used_layers(self):
-        """Add each subset to the correct list for each input layers"""
-        for name in self.in_names:
-            src_ds = gdal.Open(name)
-            layers = src_ds.GetSubDatasets()
+            # the first file sets the subsets and the layers order
+            if n == 0 and not self.subset:
+                self.subset = [1 for i in range(len(layers))]
 
             for i, sub in enumerate(self.subset):
                 name = layers[i][0].split(':')[-1].strip('"')
                 sub = str(sub)
+                if sub != name and sub != '1':
+                    continue
 
-                if sub == name or sub == "1":
-                    self.layers[name].append(layers[i][0])
+                if n == 0:
+                    self.layers[name] = list()
+                    self.file_infos[name] = []
 
-    def _names_to_file_infos(self):
-        """Translate a list of GDAL filenames, into file_info objects.
-        Returns a list of file_info objects. There may be less file_info
-        objects than names if some of the names could not be opened as GDAL
-        files.
-        """
-        self.file_infos = OrderedDict()
-        for k, v in self.layers.items():
-            self.file_infos[k] = []
-            for name in v:
+                self.layers[name].append(layers[i][0])
                 fi = FileInfo()
-                if fi.init_from_name(name) == 1:
-                    self.file_infos[k].append(fi)
+                if fi.init_from_name(layers[i][0]) == 1:
+                    self.file_infos[name].append(fi)
 
     def _calculate_new_size(self):
         """Return the new size of output raster
 
            :return: X size, Y size and geotransform parameters
         """
+        if self._new_size is not None:
+            return self._new_size
+
         values = list(self.file_infos.values())
         l1 = values[0][0]
         ulx = l1.ulx
@@ -338,51 +429,70 @@ class CreateMosaicGDAL:
         geo_transform = [ulx, p_size_x, 0, uly, 0, p_size_y]
         x_size = int((lrx - ulx) / geo_transform[1] + 0.5)
         y_size = int((lry - uly) / geo_transform[5] + 0.5)
-        return x_size, y_size, geo_transform
+        self._new_size = x_size, y_size, geo_transform
+        return self._new_size
 
     def run(self, output, quiet=False, dst_srs=None):
-        """Create the mosaic
+        """Create the mosaic with GDAL, building a VRT of the tiles of each
+        layer and writing them out in a single Translate, or Warp if dst_srs
+        is given
            :param str output: the name of output file
         """
-        values = list(self.file_infos.values())
-        l1 = values[0][0]
-        x_size, y_size, geo_transform = self._calculate_new_size()
-
-        if dst_srs:
-            output_file = tempfile.NamedTemporaryFile(delete=False).name
-        else:
-            output_file = output
-
-        t_fh = self.driver.Create(output_file, x_size, y_size,
-                                  len(list(self.file_infos.keys())),
-                                  l1.band_type)
-        if t_fh is None:
+        try:
+            kwargs = {'format': self.out_format}
+            if self.out_format == 'GTiff':
+                kwargs['creationOptions'] = GTIFF_CREATION_OPTIONS
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                layer_vrts = []
+                for i, names in enumerate(self.file_infos.values()):
+                    layer_vrt = os.path.join(tmp_dir, '{i}.vrt'.format(i=i))
+                    self._build_layer_vrt(layer_vrt, names)
+                    layer_vrts.append(layer_vrt)
+
+                mosaic_vrt = os.path.join(tmp_dir, 'mosaic.vrt')
+                vrt_ds = gdal.BuildVRT(mosaic_vrt, layer_vrts, separate=True)
+                if vrt_ds is None:
+                    raise Exception('Not possible to create dataset %s' % output)
+
+                if dst_srs:
+                    t_fh = gdal.Warp(output, vrt_ds, dstSRS=dst_srs,
+                                     multithread=True, warpMemoryLimit=2048,
+                                     warpOptions=['NUM_THREADS=ALL_CPUS'],
+                                     **kwargs)
+                else:
+                    t_fh = gdal.Translate(output, vrt_ds, **kwargs)
+
+                if t_fh is None:
+                    raise Exception('Not possible to create dataset %s' % output)
+
+                t_fh = None
+                vrt_ds = None
+
+            if not quiet:
+                print("The mosaic file {name} has been "
+                      "created".format(name=output))
+            return True
+        finally:
+            # release the input files, also when the mosaic failed
+            _open_ds.cache_clear()
+
+    @staticmethod
+    def _build_layer_vrt(output, names):
+        """Write a VRT mosaic of the tiles of a layer with GDAL
+
+        :param str output: the name of the VRT file
+        :param list names: the file_info objects of the layer tiles
+        """
+        fill = names[0].fill_value or None
+        vrt_options = gdal.BuildVRTOptions(resolution='highest',
+                                           srcNodata=fill, VRTNodata=fill)
+        vrt_ds = gdal.BuildVRT(output, [n.filename for n in names],
+                               options=vrt_options)
+        if vrt_ds is None:
             raise Exception('Not possible to create dataset %s' % output)
-
-        t_fh.SetGeoTransform(geo_transform)
-        t_fh.SetProjection(l1.projection)
-        i = 1
-        for names in list(self.file_infos.values()):
-            fill = None
-            if names[0].fill_value:
-                fill = float(names[0].fill_value)
-                t_fh.GetRasterBand(i).SetNoDataValue(fill)
-                t_fh.GetRasterBand(i).Fill(fill)
-            for n in names:
-                n.copy_into(t_fh, 1, i, fill)
-            i = i + 1
-        # self.write_mosaic_xml(output)
-
-        if dst_srs:
-            kwargs = {'format': self.out_format, 'dstSRS': dst_srs}
-            gdal.Warp(destNameOrDestDS=output, srcDSOrSrcDSTab=t_fh, **kwargs)
-
-        t_fh = None
-
-        if not quiet:
-            print("The mosaic file {name} has been "
-                  "created".format(name=output))
-        return True
+        vrt_ds.FlushCache()
+        vrt_ds = None
 
     def _calculate_off_set(self, fileinfo, geo_transform):
         """Return the offset between main origin and the origin of current
@@ -405,65 +515,31 @@ class CreateMosaicGDAL:
 
         def write_complex(f, geot, band=1):
             """Write a complex source to VRT file"""
-            out.write('\t\t<ComplexSource>\n')
-            out.write('\t\t\t<SourceFilename relativeToVRT="0">{name}'
-                      '</SourceFilename>\n'.format(name=f.filename.replace('"', '')))
-            out.write('\t\t\t<SourceBand>{nb}</SourceBand>\n'.format(nb=band))
-            out.write('\t\t\t<SourceProperties RasterXSize="{x}" '
-                      'RasterYSize="{y}" DataType="{typ}" '
-                      'BlockXSize="{bx}" BlockYSize="{by}" />'
-                      '\n'.format(x=f.xsize, y=f.ysize,
-                                  typ=gdal.GetDataTypeName(f.band_type),
-                                  bx=f.block_size[0], by=f.block_size[1]))
-            out.write('\t\t\t<SrcRect xOff="0" yOff="0" xSize="{x}" '
-                      'ySize="{y}" />\n'.format(x=f.xsize, y=f.ysize))
             x_off, y_off = self._calculate_off_set(f, geot)
-            out.write('\t\t\t<DstRect xOff="{xoff}" yOff="{yoff}" '
-                      'xSize="{x}" ySize="{y}" />'
-                      '\n'.format(xoff=x_off, yoff=y_off, x=f.xsize,
-                                  y=f.ysize))
+            nodata = ''
             if l1.fill_value:
-                out.write('\t\t\t<NODATA>{va}</NODATA>'
-                          '\n'.format(va=f.fill_value))
-            out.write('\t\t</ComplexSource>\n')
+                nodata = '\t\t\t<NODATA>{va}</NODATA>\n'.format(va=f.fill_value)
+            out.write(COMPLEX_SOURCE_VRT % {
+                'name': f.filename.replace('"', ''), 'band': band,
+                'x': f.xsize, 'y': f.ysize,
+                'typ': gdal.GetDataTypeName(f.band_type),
+                'bx': f.block_size[0], 'by': f.block_size[1],
+                'xoff': x_off, 'yoff': y_off, 'nodata': nodata})
 
-        x_size, y_size, geot = self._calculate_new_size()
         if separate:
-            for k in list(self.file_infos.keys()):
-                l1 = self.file_infos[k][0]
-                out = open("{pref}_{band}.vrt".format(pref=output, band=k),
-                           'w')
-                out.write('<VRTDataset rasterXSize="{x}" rasterYSize="{y}">'
-                          '\n'.format(x=x_size, y=y_size))
-                out.write('\t<SRS>{proj}</SRS>\n'.format(proj=l1.projection))
-                out.write('\t<GeoTransform>{geo0}, {geo1}, {geo2}, {geo3},'
-                          ' {geo4}, {geo5}</GeoTransform>'
-                          '\n'.format(geo0=geot[0], geo1=geot[1], geo2=geot[2],
-                                      geo3=geot[3], geo4=geot[4],
-                                      geo5=geot[5]))
-                gtype = gdal.GetDataTypeName(l1.band_type)
-                # count max number of band
-                n_bands = 0
-                for f in self.file_infos[k]:
-                    n_bands = max(n_bands, f.bands)
-                for b in range(n_bands):
-                    out.write('\t<VRTRasterBand dataType="{typ}" band="{band}"'
-                              '>\n'.format(typ=gtype, band=b + 1))
-                    if l1.fill_value:
-                        out.write('\t\t<NoDataValue>{val}</NoDataValue'
-                                  '>\n'.format(val=l1.fill_value))
-                    out.write('<ColorInterp>Gray</ColorInterp>\n')
-                    for f in self.file_infos[k]:
-                        if b < f.bands:
-                            write_complex(f, geot, band=b + 1)
-                    out.write('\t</VRTRasterBand>\n')
-                out.write('</VRTDataset>\n')
-                out.close()
+            for k, names in self.file_infos.items():
+                self._build_layer_vrt("{pref}_{band}.vrt".format(pref=output,
+                                                                 band=k),
+                                      names)
         else:
+            # BuildVRT can either mosaic the tiles or stack the layers in a
+            # single file, not both, so the unique file is written here
+            x_size, y_size, geot = self._calculate_new_size()
             values = list(self.file_infos.values())
             l1 = values[0][0]
             band = 1  # the number of band
-            out = open("{pref}.vrt".format(pref=output), 'w')
+            # build the VRT in memory and write it at once
+            out = io.StringIO()
             out.write('<VRTDataset rasterXSize="{x}" rasterYSize="{y}">'
                       '\n'.format(x=x_size, y=y_size))
             out.write('\t<SRS>{proj}</SRS>\n'.format(proj=l1.projection))
@@ -485,7 +561,8 @@ class CreateMosaicGDAL:
                 out.write('\t</VRTRasterBand>\n')
                 band += 1
             out.write('</VRTDataset>\n')
-            out.close()
+            with open("{pref}.vrt".format(pref=output), 'w') as vrt_file:
+                vrt_file.write(out.getvalue())
         if not quiet:
             print("The VRT mosaic file {name} has been "
                   "created".format(name=output))
@@ -1,43 +1,53 @@
 import datetime
-import math
+import functools
 import re
 
 import numpy as np
-import requests
 from pyproj import Proj
 from html.parser import HTMLParser
 
 from ingest.auth import BearerAuth
-from ingest.utils import download_to_file
+from ingest.utils import download_to_file, http_session, REQUESTS_TIMEOUT
 
 
-def get_modland_grids(min_lon, max_lon, min_lat, max_lat):
-    # Define function to convert lon/lat to sinusoidal x/y coordinates
-    def lon_lat_to_xy(lon, lat):
-        r = 6371007.181
-        x = r * np.radians(lon) * np.cos(np.radians(lat))
-        y = r * np.radians(lat)
-        return x, y
+# MODIS sinusoidal grid, 36 x 18 tiles of 10 x 10 degrees at the equator
+MODIS_SPHERE_RADIUS = 6371007.181
+MODIS_TILE_SIZE = 1111950.5197665
+MODIS_GRID_ULX = -20015109.354
+MODIS_GRID_ULY = 10007554.677
+MODIS_NTILE_HORIZ = 36
+MODIS_NTILE_VERT = 18
+
+DATE_DIR_REGEX = re.compile(r'(\d{4})[/.-](\d{2})[/.-](\d{2})$')
+
+
+@functools.lru_cache(maxsize=64)
+def modland_grid_bounds(min_lon, max_lon, min_lat, max_lat):
+    """Return the (iv_min, iv_max, ih_min, ih_max) MODIS tile index range of a bbox.
+    Cached, the extents are fixed per dataset and asked for on every run"""
+    # bbox edges, and the latitude closest to the equator where the
+    # sinusoidal x extent is the widest
+    lons = np.radians([min_lon, max_lon])
+    lats = np.radians([min_lat, max_lat, np.clip(0, min_lat, max_lat)])
 
     # Convert bbox to sinusoidal x/y coordinates
-    min_x, min_y = lon_lat_to_xy(min_lon, min_lat)
-    max_x, max_y = lon_lat_to_xy(max_lon, max_lat)
+    lon, lat = np.meshgrid(lons, lats)
+    x = MODIS_SPHERE_RADIUS * lon * np.cos(lat)
+    y = MODIS_SPHERE_RADIUS * lats
 
     # Determine range of grid indices that intersect with bbox
-    ntile_vert = 18
-    ntile_horiz = 36
-    iv_min = math.floor((90.0 + min_y) / 10.0)
-    iv_max = math.floor((90.0 + max_y) / 10.0)
-    ih_min = math.floor((180.0 + min_x) / 10.0)
-    ih_max = math.floor((180.0 + max_x) / 10.0)
+    ih_min, ih_max = np.clip(np.floor((np.array([x.min(), x.max()]) - MODIS_GRID_ULX) / MODIS_TILE_SIZE),
+                             0, MODIS_NTILE_HORIZ - 1).astype(int)
+    iv_min, iv_max = np.clip(np.floor((MODIS_GRID_ULY - np.array([y.max(), y.min()])) / MODIS_TILE_SIZE),
+                             0, MODIS_NTILE_VERT - 1).astype(int)
 
-    # Loop through grid cells that intersect with bbox and add to list
-    grids = []
-    for iv in range(iv_min, iv_max + 1):
-        for ih in range(ih_min, ih_max + 1):
-            grids.append(f'h{iv:02d}v{ih:02d}')
+    return int(iv_min), int(iv_max), int(ih_min), int(ih_max)
 
-    return grids
+
+def get_modland_grids(min_lon, max_lon, min_lat, max_lat):
+    iv_min, iv_max, ih_min, ih_max = modland_grid_bounds(min_lon, max_lon, min_lat, max_lat)
+
+    return [f'h{ih:02d}v{iv:02d}' for iv in range(iv_min, iv_max + 1) for ih in range(ih_min, ih_max + 1)]
 
 
 class ModisHtmlParser(HTMLParser):
@@ -62,8 +72,7 @@ class ModisHtmlParser(HTMLParser):
 
     def get_dates(self):
         """Return a list of directories with date"""
-        regex = re.compile('(\d{4})[/.-](\d{2})[/.-](\d{2})$')
-        alldata = set([elem for elem in self.file_ids if regex.match(elem)])
+        alldata = set([elem for elem in self.file_ids if DATE_DIR_REGEX.match(elem)])
         return sorted(list(alldata))
 
     def get_tiles(self, product_code, tiles=None, jpeg=False):
@@ -74,31 +83,31 @@ class ModisHtmlParser(HTMLParser):
            :param bool jpeg: True to also check for jpeg data
         """
         final_list = []
+        tile_set = set(tiles) if tiles else None
         for i in self.file_ids:
             # distinguish jpg from hdf by where the tileID is within the string
             # jpgs have the tileID at index 3, hdf have tileID at index 2
             name = i.split('.')
+            name_parts = set(name)
             # if product is not in the filename, move to next filename in list
 
-            if not name.count(product_code):
+            if product_code not in name_parts:
                 continue
 
             # skip xml
-            if name.count("xml"):
+            if "xml" in name_parts:
                 continue
 
             # if tiles are not specified and the file is not a jpg, add to list
-            if not tiles and not (name.count('jpg') or name.count('BROWSE')):
+            if not tile_set:
+                if 'jpg' not in name_parts and 'BROWSE' not in name_parts:
+                    final_list.append(i)
+            # if a tileID is at index 3 and jpgs are to be downloaded
+            elif jpeg and len(name) > 3 and name[3] in tile_set:
+                final_list.append(i)
+            # if a tileID is at in index 2, it is known to be HDF
+            elif len(name) > 2 and name[2] in tile_set:
                 final_list.append(i)
-            # if tiles are specified
-            if tiles:
-                for tile in tiles:
-                    # if a tileID is at index 3 and jpgs are to be downloaded
-                    if jpeg and tile == name[3]:
-                        final_list.append(i)
-                    # if a tileID is at in index 2, it is known to be HDF
-                    elif tile == name[2]:
-                        final_list.append(i)
         return final_list
 
 
@@ -135,7 +144,7 @@ class ModisDownloader(object):
         date = datetime.datetime.fromisoformat(date)
         data_date = date.strftime("%Y.%m.%d")
         url = urljoin(self.base_url, self.data_path, data_date)
-        r = requests.get(url)
+        r = http_session.get(url, timeout=REQUESTS_TIMEOUT)
 
         if r.status_code == 404:
             return False, url
@@ -151,7 +160,7 @@ class ModisDownloader(object):
         return tiles
 
     def get_date_tile_files(self, date_url, tiles=None):
-        r = requests.get(date_url)
+        r = http_session.get(date_url, timeout=REQUESTS_TIMEOUT)
         html = ModisHtmlParser(r.text)
         tiles = html.get_tiles(self.product_code, tiles=tiles)
         return tiles
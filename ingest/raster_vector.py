@@ -1,31 +1,64 @@
-import json
-from datetime import datetime
+import io
+import struct
+from datetime import datetime, timedelta
+from itertools import islice
+from operator import itemgetter
 
+import numpy as np
 import psycopg2
-from geojson import loads
-from psycopg2.extras import execute_values
-from shapely.geometry import LineString
-from shapely.geometry import shape
+import shapely
+from psycopg2 import sql
 
 from ingest.errors import UnKnownGeomType
 
+# number of features processed and copied to the db at a time
+INSERT_BATCH_SIZE = 10000
 
-def fix_linestring_within_world_extents(linestring):
-    def fix_coordinates(coords):
-        def clamp(val, min_val, max_val):
-            return max(min(val, max_val), min_val)
+# binary COPY framing, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+PGCOPY_FIELD_LENGTH = struct.Struct(">i")
+PGCOPY_TIMESTAMP = struct.Struct(">iq")
+PGCOPY_REAL = struct.Struct(">if")
+PGCOPY_NULL = PGCOPY_FIELD_LENGTH.pack(-1)
+# binary timestamps are microseconds since the postgres epoch
+PG_EPOCH = datetime(2000, 1, 1)
 
-        fixed_coords = []
-        for lon, lat in coords:
-            fixed_lon = clamp(lon, -180, 180)
-            fixed_lat = clamp(lat, -90, 90)
-            fixed_coords.append((fixed_lon, fixed_lat))
-        return fixed_coords
+# shapely geometry type ids of the allowed geom types
+GEOM_TYPE_IDS = {"Point": 0, "LineString": 1, "Polygon": 3, "MultiPoint": 4, "MultiLineString": 5,
+                 "MultiPolygon": 6}
 
-    if not linestring.is_simple:
-        linestring = linestring.simplify(tolerance=0.001, preserve_topology=True)
-    fixed_line_coords = fix_coordinates(linestring.coords)
-    return LineString(fixed_line_coords)
+
+def fix_linestrings_within_world_extents(linestrings):
+    not_simple = ~shapely.is_simple(linestrings)
+    linestrings[not_simple] = shapely.simplify(linestrings[not_simple], tolerance=0.001, preserve_topology=True)
+
+    coords = shapely.get_coordinates(linestrings)
+    np.clip(coords, [-180, -90], [180, 90], out=coords)
+    return shapely.set_coordinates(linestrings, coords)
+
+
+def copy_rows(cur, table_identifier, columns, rows):
+    """Load (date, geom EWKB bytes, *REAL values) rows into a table with a binary COPY, so PostGIS reads the
+    geometries as WKB without parsing any text"""
+    buffer = io.BytesIO()
+    buffer.write(PGCOPY_HEADER)
+
+    field_count = struct.pack(">h", len(columns))
+    for date, geom_ewkb, *values in rows:
+        buffer.write(field_count)
+        buffer.write(PGCOPY_TIMESTAMP.pack(8, (date - PG_EPOCH) // timedelta(microseconds=1)))
+        buffer.write(PGCOPY_FIELD_LENGTH.pack(len(geom_ewkb)))
+        buffer.write(geom_ewkb)
+        for value in values:
+            buffer.write(PGCOPY_NULL if value is None else PGCOPY_REAL.pack(4, value))
+
+    buffer.write(PGCOPY_TRAILER)
+    buffer.seek(0)
+
+    copy_sql = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT binary)").format(
+        table_identifier, sql.SQL(", ").join(map(sql.Identifier, columns)))
+    cur.copy_expert(copy_sql.as_string(cur), buffer)
 
 
 def is_valid_geom_type(geom_type):
@@ -50,30 +83,49 @@ class VectorDbManager:
         self.srid = srid
 
         self.data_columns = data_columns
+        # gets the data column values of feature properties as a tuple
+        if not data_columns:
+            self.get_data_columns_values = lambda properties: ()
+        elif len(data_columns) == 1:
+            column_getter = itemgetter(data_columns[0])
+            self.get_data_columns_values = lambda properties: (column_getter(properties),)
+        else:
+            self.get_data_columns_values = itemgetter(*data_columns)
         self.delete_past_data = delete_past_data
 
+        # one connection for the lifetime of the manager. Each `with self.conn` block is a transaction,
+        # committed on exit, the connection stays open until close is called
+        self.conn = psycopg2.connect(**self.conn_params)
+
         # initialize db
-        self.enable_postgis_extension()
-        self.create_schema_if_not_exists()
-        self.create_table_if_not_exists()
-        self.create_or_replace_mvt_function()
+        try:
+            self.enable_postgis_extension()
+            self.create_schema_if_not_exists()
+            self.create_table_if_not_exists()
+            self.create_or_replace_mvt_function()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        self.conn.close()
 
     def enable_postgis_extension(self):
-        with psycopg2.connect(**self.conn_params) as conn:
-            with conn.cursor() as cur:
+        with self.conn:
+            with self.conn.cursor() as cur:
                 cur.execute("CREATE EXTENSION IF NOT EXISTS postgis")
 
     def create_schema_if_not_exists(self):
-        with psycopg2.connect(**self.conn_params) as conn:
-            with conn.cursor() as cur:
+        with self.conn:
+            with self.conn.cursor() as cur:
                 cur.execute(f"CREATE SCHEMA IF NOT EXISTS {self.schema_name}")
 
     def create_table_if_not_exists(self):
         data_columns_sql = ', '.join([f"{column_name} REAL" for column_name in self.data_columns])
         data_columns_sql = f', {data_columns_sql}'
 
-        with psycopg2.connect(**self.conn_params) as conn:
-            with conn.cursor() as cur:
+        with self.conn:
+            with self.conn.cursor() as cur:
                 cur.execute(f'''CREATE TABLE IF NOT EXISTS {self.full_table_name}
                                (id SERIAL PRIMARY KEY,
                                 date TIMESTAMP,
@@ -84,8 +136,8 @@ class VectorDbManager:
         # Prepare the additional_columns string
         additional_columns_str = ', '.join([f"t.{col}" for col in self.data_columns])
 
-        with psycopg2.connect(**self.conn_params) as conn:
-            with conn.cursor() as cur:
+        with self.conn:
+            with self.conn.cursor() as cur:
                 # Create the dynamic SQL string
                 sql = f"""
                 CREATE OR REPLACE
@@ -114,51 +166,54 @@ class VectorDbManager:
 
                 cur.execute(sql)
 
-    def process_geojson(self, date_str, data_file):
-        with open(data_file) as f:
-            data = json.load(f)
+    def iter_layer_rows(self, date_str, layer, batch_size=INSERT_BATCH_SIZE):
+        """Yield the rows of the features of an OGR layer in batches"""
+        date = datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S.%fZ")
+        features = iter(layer)
 
-        rows = []
-        for feature in data['features']:
-            date = datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%S.%fZ")
-            geometry = loads(json.dumps(feature['geometry']))
-            geom_type = geometry.get("type")
+        while True:
+            batch = list(islice(features, batch_size))
+            if not batch:
+                return
 
-            if geom_type != self.geom_type:
-                raise UnKnownGeomType(
-                    f"GeomType from feature {geom_type} is different from table geom type: {self.geom_type}")
+            geoms = shapely.from_wkb(np.array([bytes(feature.GetGeometryRef().ExportToWkb()) for feature in batch],
+                                              dtype=object))
+            properties = [{column_name: feature.GetField(column_name) for column_name in self.data_columns}
+                          for feature in batch]
+            yield self.process_geometries(date, geoms, properties)
 
-            shapely_geom = shape(geometry)
+    def process_geometries(self, date, geoms, properties):
+        geom_type_ids = shapely.get_type_id(geoms)
+        if np.any(geom_type_ids != GEOM_TYPE_IDS[self.geom_type]):
+            raise UnKnownGeomType(
+                f"GeomType from feature is different from table geom type: {self.geom_type}")
 
-            if geom_type == "LineString":
-                geom = fix_linestring_within_world_extents(shapely_geom)
-                shapely_geom = shape(geom)
+        if self.geom_type == "LineString":
+            geoms = fix_linestrings_within_world_extents(geoms)
 
-            custom_columns_values = []
-            for column_name in self.data_columns:
-                col_value = feature['properties'][column_name]
-                custom_columns_values.append(col_value)
+        # serialize all geometries at once
+        geoms = shapely.set_srid(geoms, self.srid)
+        geoms_ewkb = shapely.to_wkb(geoms, include_srid=True)
 
-            rows.append((date, shapely_geom.wkt, *custom_columns_values,))
+        get_values = self.get_data_columns_values
+        return [(date, geom_ewkb, *get_values(feature_properties),)
+                for feature_properties, geom_ewkb in zip(properties, geoms_ewkb)]
 
-        return rows
+    def insert_update_layer(self, date_str, layer, latest_date_str=None):
+        self.insert_update_rows(date_str, self.iter_layer_rows(date_str, layer), latest_date_str=latest_date_str)
 
-    def insert_update_data(self, date_str, data_file, latest_date_str=None):
-        rows = self.process_geojson(date_str, data_file)
+    def insert_update_rows(self, date_str, row_batches, latest_date_str=None):
         columns = ["date", "geom", *self.data_columns]
-        column_names = ', '.join(columns)
-
-        with psycopg2.connect(**self.conn_params) as conn:
-            with conn.cursor() as cur:
-                cur.execute(f"SELECT COUNT(*) FROM {self.full_table_name} WHERE date = '{date_str}'")
-                count = cur.fetchone()[0]
-
-                if count > 0:
-                    cur.execute(f"DELETE FROM {self.full_table_name} WHERE date = '{date_str}'")
+        table = sql.Identifier(self.schema_name, self.table_name)
 
-                sql = f"INSERT INTO {self.full_table_name} ({column_names}) VALUES %s"
+        # replace the date data in a single transaction, committed when the connection block exits.
+        # the delete uses the date index and is cheap when there is nothing to replace
+        with self.conn:
+            with self.conn.cursor() as cur:
+                cur.execute(sql.SQL("DELETE FROM {} WHERE date = %s").format(table), (date_str,))
 
-                execute_values(cur, sql, rows)
+                for rows in row_batches:
+                    copy_rows(cur, table, columns, rows)
 
                 if self.delete_past_data and latest_date_str:
-                    cur.execute(f"DELETE FROM {self.full_table_name} WHERE date < '{latest_date_str}'")
+                    cur.execute(sql.SQL("DELETE FROM {} WHERE date < %s").format(table), (latest_date_str,))
@@ -7,9 +7,12 @@ import requests
 
 from ingest import DataIngest
 from ingest.dateutils import get_next_month_date, get_next_pentad
-from ingest.utils import download_file_temp
+from ingest.utils import download_file_temp, COG_CREATION_OPTIONS, run_concurrently
 import rioxarray as rxr
 
+# number of param files of a period downloaded at the same time
+DOWNLOAD_WORKERS = 4
+
 CONFIG = {
     "params": {
         "rainfall_estimate": {
@@ -103,6 +106,7 @@ class TamSatRainfall(DataIngest):
             next_data_month = period_config.get("start_month")
             next_date = datetime(int(next_data_year), int(next_data_month), 1)
 
+        tasks = []
         for param, file_template in period_config.get("data_file_templates", {}).items():
             param_detail = self.params.get(param, {})
 
@@ -114,23 +118,9 @@ class TamSatRainfall(DataIngest):
 
             url = f"{self.base_data_url}{download_file_path}"
 
-            logging.info(f'[TAMSAT_RAINFALL]: Downloading {param} Monthly Data with url {url} and date: {next_date}')
-
-            try:
-                self.download_and_save_file(url, period="monthly", param=param, variables=variables,
-                                            data_date=next_date)
-                date_str = next_date.isoformat()
-                self.update_state({"monthly": date_str})
+            tasks.append((param, url, variables))
 
-                logging.info(f'[TAMSAT_RAINFALL]: Monthly {param} download success for date:{next_date}!')
-            except requests.exceptions.HTTPError as e:
-                # file not found
-                if e.response.status_code == 404:
-                    logging.info(
-                        f"[TAMSTAT_RAINFALL]: Request data not yet available: {url}, date: {next_date}. Skipping...")
-                    return
-                else:
-                    raise e
+        self.download_period_files("monthly", tasks, data_date=next_date)
 
     def run_pentadal(self):
         logging.info('[TAMSAT_RAINFALL]: Trying Pentadal Data...')
@@ -148,6 +138,7 @@ class TamSatRainfall(DataIngest):
             next_pentad_date = datetime(int(next_data_year), int(next_data_month), int(next_data_pentad))
             next_pentad_num = 1
 
+        tasks = []
         for param, file_template in period_config.get("data_file_templates", {}).items():
             param_detail = self.params.get(param, {})
 
@@ -160,24 +151,38 @@ class TamSatRainfall(DataIngest):
 
             url = f"{self.base_data_url}{download_file_path}"
 
-            logging.info(
-                f'[TAMSAT_RAINFALL]: Downloading {param} Pentadal Data with url {url} and date: {next_pentad_date}')
-
-            try:
-                self.download_and_save_file(url, period="pentadal", param=param, variables=variables,
-                                            data_date=next_pentad_date)
-                date_str = next_pentad_date.isoformat()
-                self.update_state({"pentadal": date_str})
-
-                logging.info(f'[TAMSAT_RAINFALL]: Pentadal {param} download success for date:{next_pentad_date}!')
-            except requests.exceptions.HTTPError as e:
-                # file not found
-                if e.response.status_code == 404:
-                    logging.info(
-                        f"[TAMSTAT_RAINFALL]: Request pentadal data not yet available: {url}, date: {next_pentad_date}. Skipping...")
-                    return
-                else:
-                    raise e
+            tasks.append((param, url, variables))
+
+        self.download_period_files("pentadal", tasks, data_date=next_pentad_date)
+
+    def download_period_files(self, period, tasks, data_date):
+        # the param files are independent, download them concurrently
+        available = run_concurrently(self.download_param_file,
+                                     [(period, param, url, variables, data_date) for param, url, variables in tasks],
+                                     max_workers=DOWNLOAD_WORKERS)
+
+        # make sure all ingest commands were sent before updating state
+        self.wait_for_ingest_commands()
+
+        # the state follows the first param only. A later param that is not yet available is skipped for this date
+        if available and available[0]:
+            self.update_state({period: data_date.isoformat()})
+
+    def download_param_file(self, period, param, url, variables, data_date):
+        logging.info(f'[TAMSAT_RAINFALL]: Downloading {param} {period} Data with url {url} and date: {data_date}')
+
+        try:
+            self.download_and_save_file(url, period=period, param=param, variables=variables, data_date=data_date)
+        except requests.exceptions.HTTPError as e:
+            # file not found
+            if e.response.status_code == 404:
+                logging.info(
+                    f"[TAMSTAT_RAINFALL]: Request {period} data not yet available: {url}, date: {data_date}. Skipping...")
+                return False
+            raise e
+
+        logging.info(f'[TAMSAT_RAINFALL]: {period} {param} download success for date:{data_date}!')
+        return True
 
     def download_and_save_file(self, url, period, param, variables, data_date):
 
@@ -186,33 +191,42 @@ class TamSatRainfall(DataIngest):
         # open dataset
         ds = rxr.open_rasterio(data_file)
 
-        # write crs
-        ds.rio.write_crs("epsg:4326", inplace=True)
+        try:
+            # write crs
+            ds.rio.write_crs("epsg:4326", inplace=True)
 
-        date_str = data_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            date_str = data_date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
 
-        for var in variables:
-            namespace = f"tamsat_{period}_{param}_{var}"
+            write_tasks = []
+            for var in variables:
+                namespace = f"tamsat_{period}_{param}_{var}"
 
-            if var in ds.variables:
-                # we expect time to be always of length 1 because we requested for only one timestamp
-                data_array = ds[var].isel(time=0)
+                if var in ds.variables:
+                    # we expect time to be always of length 1 because we requested for only one timestamp
+                    data_array = ds[var].isel(time=0)
 
-                data_dir = os.path.join(self.output_dir, namespace)
-                out_file = os.path.join(data_dir, f"{namespace}_{date_str}.tif")
+                    data_dir = os.path.join(self.output_dir, namespace)
+                    out_file = os.path.join(data_dir, f"{namespace}_{date_str}.tif")
 
-                # create data dir
-                Path(out_file).parent.absolute().mkdir(parents=True, exist_ok=True)
+                    write_tasks.append((namespace, data_dir, data_array, out_file))
 
-                data_array.rio.to_raster(out_file, driver="COG", compress="DEFLATE")
+            # the variables are independent, write their COGs concurrently
+            run_concurrently(self.save_variable, [task[2:] for task in write_tasks],
+                             max_workers=max(len(write_tasks), 1))
+        finally:
+            ds.close()
+            os.remove(data_file)
 
-                ingest_payload = {
-                    "namespace": f"-n {namespace}",
-                    "path": f"-p {data_dir}",
-                    "datatype": "-t tif",
-                    "args": "-x -conf /rulesets/namespace_yyy-mm-ddTH.tif.json"
-                }
+        for namespace, data_dir, _, _ in write_tasks:
+            ingest_payload = self.get_ingest_payload(namespace, data_dir)
 
-                logging.info(
-                    f"[TAMSTAT_RAINFALL]: Sending ingest command for param: {namespace} and date: {date_str}")
-                self.send_ingest_command(ingest_payload)
+            logging.info(
+                f"[TAMSTAT_RAINFALL]: Sending ingest command for param: {namespace} and date: {date_str}")
+            self.dispatch_ingest_command(ingest_payload)
+
+    @staticmethod
+    def save_variable(data_array, out_file):
+        # create data dir
+        Path(out_file).parent.absolute().mkdir(parents=True, exist_ok=True)
+
+        data_array.rio.to_raster(out_file, **COG_CREATION_OPTIONS)
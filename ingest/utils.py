@@ -1,25 +1,82 @@
+import copy
 import json
 import logging
 import os
 import re
 import shutil
 import stat
-import subprocess
 import tempfile
-from pathlib import Path
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
+import cfgrib
+import numpy as np
+import pandas as pd
 import pytz
 import requests
 import rioxarray as rxr
+import xarray as xr
 from dateutil import parser
+from osgeo import gdal, ogr
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from config import SETTINGS
-from ingest.errors import UnknownDataConvertOperation
+from ingest.errors import UnknownDataConvertOperation, ContourGenerationError
 
 DATASET_STATE_DIR = SETTINGS.get("DATASET_STATE_DIR")
 
 DATASET_STATE_FILE = os.path.join(DATASET_STATE_DIR, "state.json")
 
+# parsed state file, reused until the file changes on disk. The state lock also
+# serializes the read-modify-write of update_state between concurrent jobs
+state_cache = {"file_key": None, "state": {}}
+state_lock = threading.Lock()
+
+REQUESTS_TIMEOUT = SETTINGS.get("REQUESTS_TIMEOUT")
+
+# COG creation options for rio.to_raster. PREDICTOR=YES lets GDAL pick the
+# floating point predictor for float data and horizontal differencing for integers.
+# Overviews are averaged, which suits continuous fields better than the default resampling
+COG_CREATION_OPTIONS = {
+    "driver": "COG",
+    "compress": SETTINGS.get("COG_COMPRESS"),
+    "predictor": "YES",
+    "num_threads": "ALL_CPUS",
+    "blocksize": 512,
+    "overview_resampling": "AVERAGE",
+    "bigtiff": "IF_SAFER",
+}
+
+INGEST_TMPDIR = SETTINGS.get("INGEST_TMPDIR")
+# minimum free space required to use INGEST_TMPDIR, before falling back to the system temp dir
+INGEST_TMPDIR_MIN_FREE_BYTES = 2 * 1024 ** 3
+
+# number of rasters written concurrently. GDAL releases the GIL while compressing and writing
+RASTER_WRITE_WORKERS = min(16, os.cpu_count())
+
+
+def create_http_session(pool_connections=10, pool_maxsize=100, max_retries=3):
+    """Create a requests session with a pooled, retrying adapter.
+
+    Connections are kept alive and reused for all requests made through the session,
+    avoiding a new TCP/TLS handshake for every call to the same host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                          max_retries=Retry(total=max_retries, backoff_factor=0.3))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# shared session, reused across all ingest jobs
+http_session = create_http_session()
+
+# chunk size for streamed downloads
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 
 def copy_with_metadata(source, target):
     """Copy file with all its permissions and metadata.
@@ -65,11 +122,22 @@ def atomic_write(file_contents, target_file_path, mode="w"):
                 pass
 
 
+def format_time_values(time_values, date_format="%Y-%m-%dT%H:%M:%S.000Z"):
+    """Format an array of datetime64 values as date strings in a single vectorized call.
+
+    :param time_values: array of datetime64 time values e.g ds.time.values
+    :param date_format: strftime format, defaults to the format expected in ingested file names
+    :return: list of date strings
+    """
+    return pd.DatetimeIndex(time_values).strftime(date_format).tolist()
+
+
 def convert_nc_to_geotiff(in_file_path, time_index, out_file_path):
-    rds = rxr.open_rasterio(in_file_path)
+    # read lazily, only the blocks of the requested time are loaded
+    rds = rxr.open_rasterio(in_file_path, chunks=True, lock=False)
 
     try:
-        rds.isel(time=time_index).rio.to_raster(out_file_path, driver="COG")
+        rds.isel(time=time_index).rio.to_raster(out_file_path, **COG_CREATION_OPTIONS)
     except Exception as e:
         raise e
     finally:
@@ -78,6 +146,62 @@ def convert_nc_to_geotiff(in_file_path, time_index, out_file_path):
     return True
 
 
+def normalize_cfgrib_dataset(ds):
+    """Lay out a cfgrib dataset the same way as a CDO converted netCDF file.
+
+    Variables are renamed to their GRIB short names, the forecast valid time becomes the ``time``
+    dimension, pressure levels are moved to a ``plev`` dimension in Pa and spatial dimensions are
+    named ``lat`` and ``lon``.
+    :param ds: dataset as returned by cfgrib for a single hypercube
+    """
+    ds = ds.rename({name: ds[name].attrs.get("GRIB_shortName", name) for name in ds.data_vars})
+
+    if "step" in ds.dims:
+        ds = ds.swap_dims({"step": "valid_time"})
+    ds = ds.drop_vars(["time", "step"], errors="ignore").rename({"valid_time": "time"})
+    if "time" not in ds.dims:
+        ds = ds.expand_dims("time")
+
+    if "isobaricInhPa" in ds.coords:
+        ds = ds.assign_coords(isobaricInhPa=ds["isobaricInhPa"] * 100).rename({"isobaricInhPa": "plev"})
+        ds["plev"].attrs["units"] = "Pa"
+        if "plev" not in ds.dims:
+            ds = ds.expand_dims("plev", axis=1)
+
+    ds = ds.rename({"latitude": "lat", "longitude": "lon"})
+
+    # drop scalar level coordinates (e.g heightAboveGround) that would conflict when merging
+    keep_coords = ("time", "plev", "lat", "lon")
+    return ds.drop_vars([c for c in ds.coords if c not in keep_coords])
+
+
+# normalized (CDO style) dimension names to the names cfgrib opens them with
+CFGRIB_DIMS = {"time": "step", "plev": "isobaricInhPa", "lat": "latitude", "lon": "longitude"}
+
+
+def open_grib_dataset(grib_file, chunks=None):
+    """Open a GRIB file in-process with cfgrib, merging all its hypercubes into one dataset.
+
+    :param grib_file: path to the GRIB file
+    :param chunks: optional dask chunks, keyed by the normalized dimension names e.g {"time": 1}
+    """
+    open_kwargs = {}
+    if chunks:
+        # chunk at open time, using cfgrib's own dimension names, so dask reads straight from the GRIB
+        open_kwargs["chunks"] = {CFGRIB_DIMS.get(dim, dim): size for dim, size in chunks.items()}
+
+    # open_datasets reopens the file once per hypercube, share one message index between the opens.
+    # The index is only needed while opening, data reads use the byte offsets already loaded in memory
+    index_file = f"{grib_file}.{os.getpid()}.idx"
+    try:
+        datasets = cfgrib.open_datasets(grib_file, backend_kwargs={"indexpath": index_file}, **open_kwargs)
+    finally:
+        if os.path.exists(index_file):
+            os.remove(index_file)
+
+    return xr.merge([normalize_cfgrib_dataset(ds) for ds in datasets], combine_attrs="drop_conflicts")
+
+
 def write_empty_state(dataset_id):
     content = {}
     if dataset_id:
@@ -91,68 +215,136 @@ def write_empty_state(dataset_id):
     return content
 
 
+def get_state_file_key():
+    # atomic_write replaces the file, so the inode changes on every write
+    file_stat = os.stat(DATASET_STATE_FILE)
+    return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
+
+def load_state():
+    """Return the parsed state file, read again only if the file changed since the last read.
+    Call with the state lock held."""
+    file_key = get_state_file_key()
+    if state_cache["file_key"] != file_key:
+        logging.debug(f"[STATE]: Opening state file {DATASET_STATE_FILE}")
+        with open(DATASET_STATE_FILE, 'r') as f:
+            state_cache["state"] = json.load(f)
+        state_cache["file_key"] = file_key
+
+    return state_cache["state"]
+
+
 def read_state(dataset_id):
     # create state file if it does not exist
     if not os.path.isfile(DATASET_STATE_FILE):
         with open(DATASET_STATE_FILE, mode='w') as f:
             f.write("{}")
     try:
-        logging.debug(f"[STATE]: Opening state file {DATASET_STATE_FILE}")
-        with open(DATASET_STATE_FILE, 'r') as f:
-            state = json.load(f)
+        with state_lock:
+            state = load_state()
     except json.decoder.JSONDecodeError:
         state = write_empty_state(dataset_id)
 
     if state.get(dataset_id):
-        return state.get(dataset_id)
+        # copy, callers update the returned state before writing it back
+        return copy.deepcopy(state.get(dataset_id))
 
     return None
 
 
 def update_state(dataset_id, new_state):
-    with open(DATASET_STATE_FILE, 'r') as f:
-        state = json.load(f)
+    """Update the state of a dataset and write it to the state file right away, so a stopped or crashed
+    process keeps every date already ingested"""
+    with state_lock:
+        state = {**load_state(), dataset_id: new_state}
+
+        atomic_write(json.dumps(state, indent=4), DATASET_STATE_FILE)
+
+        state_cache["state"] = state
+        state_cache["file_key"] = get_state_file_key()
+
+
+def run_concurrently(func, tasks, max_workers=RASTER_WRITE_WORKERS):
+    """Call func with each tuple of arguments in tasks, using a thread pool.
+
+    :param func: function to call
+    :param tasks: iterable of argument tuples
+    :param max_workers: maximum number of threads
+    :return: list of results in the order of tasks. The first error raised by func is re-raised
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, *args) for args in tasks]
+        return [future.result() for future in futures]
+
+
+def get_temp_dir():
+    """Directory for large temporary files: INGEST_TMPDIR if set and it has enough free space,
+    otherwise None to use the system default."""
+    if INGEST_TMPDIR and os.path.isdir(INGEST_TMPDIR):
+        if shutil.disk_usage(INGEST_TMPDIR).free >= INGEST_TMPDIR_MIN_FREE_BYTES:
+            return INGEST_TMPDIR
+        logging.warning(f"[INGEST]: Not enough free space in {INGEST_TMPDIR}, using default temp dir")
+
+    return None
 
-    state[dataset_id] = new_state
 
-    atomic_write(json.dumps(state, indent=4), DATASET_STATE_FILE)
+def is_non_empty_file(file_path):
+    return os.path.isfile(file_path) and os.path.getsize(file_path) > 0
 
 
 def download_file_temp(url, auth=None, timeout=None, suffix=None):
-    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-    with requests.get(url, stream=True, auth=auth, timeout=timeout) as r:
-        r.raise_for_status()
-        for chunk in r.iter_content(chunk_size=8192):
-            tmp_file.write(chunk)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=get_temp_dir()) as tmp_file:
+        try:
+            with http_session.get(url, stream=True, auth=auth, timeout=timeout) as r:
+                r.raise_for_status()
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    tmp_file.write(chunk)
+        except Exception:
+            # do not leave partial downloads behind
+            tmp_file.close()
+            os.remove(tmp_file.name)
+            raise
     return tmp_file.name
 
 
 def download_to_file(url, out_file, auth=None, timeout=None):
     with open(out_file, "wb") as out:
-        with requests.get(url, stream=True, auth=auth, timeout=timeout) as r:
+        with http_session.get(url, stream=True, auth=auth, timeout=timeout) as r:
             r.raise_for_status()
-            for chunk in r.iter_content(chunk_size=8192):
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                 out.write(chunk)
     return out_file
 
 
+# date of data files, as in their names
+DATA_FILE_DATE_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z)')
+DATA_FILE_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def iter_file_paths(file_dir):
+    """Yield the paths of all files under file_dir, recursively"""
+    with os.scandir(file_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_file_paths(entry.path)
+            elif entry.is_file():
+                yield entry.path
+
+
 def delete_past_data_files(latest_date_str, file_dir):
     latest_date = parser.parse(latest_date_str).astimezone(pytz.utc)
-    pattern = r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z)'
 
     count = 0
 
-    for root, directories, files in os.walk(file_dir):
-        for filename in files:
-            file_path = os.path.join(root, filename)
-
-            match = re.search(pattern, file_path)
+    if os.path.isdir(file_dir):
+        for file_path in iter_file_paths(file_dir):
+            match = DATA_FILE_DATE_PATTERN.search(file_path)
 
             if match:
                 # If a match is found, extract the date and time
                 datetime_string = match.group(1)
 
-                file_date = parser.parse(datetime_string)
+                file_date = datetime.strptime(datetime_string, DATA_FILE_DATE_FORMAT).replace(tzinfo=pytz.utc)
 
                 if file_date < latest_date:
                     logging.debug(f"[CLEANUP]: Deleting file {file_path}")
@@ -163,6 +355,10 @@ def delete_past_data_files(latest_date_str, file_dir):
 
 
 def convert_data(data_array, constant, operation):
+    # keep float data in its own precision, e.g float32 data is not upcast to float64 by a float64 constant
+    if np.issubdtype(data_array.dtype, np.floating):
+        constant = np.asarray(constant, dtype=data_array.dtype)
+
     if operation == "multiply":
         return data_array * constant
     if operation == "divide":
@@ -175,30 +371,30 @@ def convert_data(data_array, constant, operation):
     raise UnknownDataConvertOperation(f"Unknown operation: {operation}")
 
 
-def generate_contour_geojson(data_file, out_dir, options):
-    data_file_name = f"{Path(data_file).stem}.geojson"
-
-    geojson_out = os.path.join(out_dir, data_file_name)
-
-    attr_name = options.get("attr_name")
-    interval = options.get("interval")
-
-    # gdal_contour command
-    command = f"gdal_contour -a {attr_name} {data_file} {geojson_out} -i {interval}"
+def get_memory_vector_driver():
+    # the OGR Memory driver is merged into MEM from GDAL 3.11, with Memory kept as an alias
+    return ogr.GetDriverByName("Memory") or ogr.GetDriverByName("MEM")
 
-    # Execute the command using subprocess
-    subprocess.run(command, shell=True, check=True)
 
-    return geojson_out
+def create_contour_data(raster_data_file, attr_name, interval):
+    """Generate the contours of a raster into an in-memory OGR datasource, same as
+    gdal_contour -a {attr_name} -i {interval}. The contours are in the first layer of the datasource,
+    keep it referenced while reading them."""
+    src_ds = gdal.Open(raster_data_file)
+    if src_ds is None:
+        raise ContourGenerationError(f"Could not open raster file for contours: {raster_data_file}")
+    band = src_ds.GetRasterBand(1)
 
+    out_ds = get_memory_vector_driver().CreateDataSource("contour")
+    layer = out_ds.CreateLayer("contour", srs=src_ds.GetSpatialRef(), geom_type=ogr.wkbLineString)
+    layer.CreateField(ogr.FieldDefn("ID", ogr.OFTInteger))
+    layer.CreateField(ogr.FieldDefn(attr_name, ogr.OFTReal))
 
-def create_contour_data(raster_data_file, attr_name, interval, out_dir):
-    # handle contour generation
-    contour_options = {
-        "attr_name": attr_name,
-        "interval": interval
-    }
+    # like gdal_contour, skip the band nodata value if it has one
+    nodata = band.GetNoDataValue()
 
-    geojson_out_file = generate_contour_geojson(raster_data_file, out_dir, contour_options)
+    result = gdal.ContourGenerate(band, float(interval), 0, [], int(nodata is not None), nodata or 0, layer, 0, 1)
+    if result != 0:
+        raise ContourGenerationError(f"Could not generate contours for raster file: {raster_data_file}")
 
-    return geojson_out_file
+    return out_ds
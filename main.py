@@ -1,6 +1,7 @@
 import logging
 import os
 
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.blocking import BlockingScheduler
 
 from config import SETTINGS
@@ -16,7 +17,10 @@ DEBUG = SETTINGS.get("DEBUG")
 TASKS_DEV = SETTINGS.get("TASKS_DEV")
 
 if __name__ == '__main__':
-    scheduler = BlockingScheduler()
+    # a thread per job, so a long running ingest never delays the others. Runs delayed by a busy job
+    # still start late instead of being dropped, and missed runs are merged into one
+    scheduler = BlockingScheduler(executors={"default": ThreadPoolExecutor(max(len(jobs), 1))},
+                                  job_defaults={"coalesce": True, "misfire_grace_time": 300})
 
     for job in jobs:
         if job.get("enabled") and not DEBUG: